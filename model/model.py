@@ -24,16 +24,49 @@ __license__ = "MIT"
 # -----------------------------------------------------------------------------
 import os
 import glob
+import hashlib
+import io
+import asyncio
+import json
+import zipfile
+from collections import OrderedDict
+import numpy as np
 import pandas as pd
 import requests
+import scipy.special
 # try-except to handle execution as a standalone and as part of Bokeh
 # application
 try:
-    from model.statemodel import StateModel
-    from model.electoralcollegemodel import ElectoralCollegeModel
+    from model.statemodel import (SEED_OBSERVATIONS,
+                                  StateModel,
+                                  poll_delta,
+                                  sigma,
+                                  win_prob)
+    from model.statestore import StateStore
+    from model.electoralstore import ElectoralStore
+    from model.electoralcollegemodel import (PARTIES,
+                                             ElectoralCollegeModel,
+                                             electoral_distribution)
+    from model.simulationmodel import SimulationModel
+    from model.producttree import ProductTree
+    from model.fetch import (FETCH_WORKERS,
+                             fetch_file,
+                             fetch_sources,
+                             file_hash)
 except ModuleNotFoundError:
-    from statemodel import StateModel
-    from electoralcollegemodel import ElectoralCollegeModel
+    from statemodel import (SEED_OBSERVATIONS,
+                            StateModel,
+                            poll_delta,
+                            sigma,
+                            win_prob)
+    from statestore import StateStore
+    from electoralstore import ElectoralStore
+    from electoralcollegemodel import (PARTIES,
+                                       ElectoralCollegeModel,
+                                       electoral_distribution)
+    from simulationmodel import SimulationModel
+    from producttree import ProductTree
+    from fetch import FETCH_WORKERS, fetch_file, fetch_sources, file_hash
 
 
 # %%---------------------------------------------------------------------------
@@ -42,11 +75,11 @@ except ModuleNotFoundError:
 def reset_error(func):
     """Reset error handling."""
 
-    def func_wrapper(*args):
+    def func_wrapper(*args, **kwargs):
         """Reset error handling."""
         args[0].error_status = False
         args[0].error_message = ''
-        return func(*args)
+        return func(*args, **kwargs)
     return func_wrapper
 
 
@@ -55,6 +88,176 @@ def reset_error(func):
 # -----------------------------------------------------------------------------
 RAWDATA = 'rawdata'
 PROCESSEDDATA = 'processeddata'
+# Number of dates what_if keeps product trees for
+SCENARIO_DATES = 8
+# Largest z-score swing_curve starts a state from, so a stored probability
+# of 0 or 1 stays finite but still rounds back to 0 or 1
+SWING_Z_LIMIT = 40
+# Columns of the poll exclusion rules that are matched against the polls
+EXCLUSION_KEYS = ['poll_id', 'question_id', 'notes', 'State name']
+# Exclusion rule notes value that matches polls with no notes
+NO_NOTES = '(none)'
+# Part of the cleaned polls cache key, change it when the cleaning changes
+POLLS_CACHE_VERSION = '2'
+# The raw polls columns the cleaning uses and their types
+POLLS_COLUMNS = {'question_id': np.int64,
+                 'poll_id': np.int64,
+                 'cycle': np.int64,
+                 'state': str,
+                 'pollster': str,
+                 'sample_size': np.float64,
+                 'population': str,
+                 'start_date': str,
+                 'end_date': str,
+                 'notes': str,
+                 'candidate_name': str,
+                 'candidate_party': str,
+                 'pct': np.float64}
+# Rows of the raw polls file read at a time
+POLLS_CHUNK_SIZE = 20000
+# Where the 2020 polls are fetched from
+POLLS_URL = ('https://projects.fivethirtyeight.com'
+             '/polls-page/president_polls.csv')
+# The poll sources for each year, fetched into RAWDATA and cleaned
+# together. Every source's file has the 538 raw polls columns, see
+# POLLS_COLUMNS. A source can also set its own timeout and retries, see
+# fetch.fetch_source.
+POLL_SOURCES = {2020: [{'name': '538',
+                        'url': POLLS_URL,
+                        'file': 'Polls_2020.csv'}]}
+
+
+# %%---------------------------------------------------------------------------
+# Functions
+# -----------------------------------------------------------------------------
+def read_exclusions(file):
+    """Return the poll exclusion rules and their version.
+
+    Each rule gives some of the EXCLUSION_KEYS, with the others blank, and
+    a reason. The version is the SHA-256 of the file, so it changes
+    whenever a rule does.
+    """
+    with open(file, 'rb') as rules_file:
+        content = rules_file.read()
+    rules = pd.read_csv(io.BytesIO(content),
+                        dtype=str,
+                        keep_default_na=False)
+    return rules, hashlib.sha256(content).hexdigest()
+
+
+def exclude_polls(polls, rules):
+    """Return the polls without the rows an exclusion rule matches.
+
+    A rule matches a row when every key it gives matches. Rules giving
+    the same keys are one set of key tuples, so each set is one hash
+    membership test of the polls' keys, and the rows any set matches are
+    removed in one filter.
+    """
+    _keys = pd.DataFrame(
+        {'poll_id': polls['poll_id'].astype(str),
+         'question_id': polls['question_id'].astype(str),
+         'notes': polls['notes'].fillna(NO_NOTES).astype(str),
+         'State name': polls['State name'].astype(str)})
+    _given = rules[EXCLUSION_KEYS] != ''
+    excluded = np.zeros(len(polls), dtype=bool)
+    for _, pattern in _given.drop_duplicates().iterrows():
+        _columns = [key for key in EXCLUSION_KEYS if pattern[key]]
+        _rules = set(rules.loc[(_given == pattern).all(axis=1), _columns]
+                     .itertuples(index=False, name=None))
+        excluded |= np.fromiter(
+            (key in _rules for key in zip(*[_keys[column].to_numpy()
+                                            for column in _columns])),
+            dtype=bool,
+            count=len(polls))
+    return polls[~excluded]
+
+
+def filter_polls(polls):
+    """Return the 2020 Trump and Biden state polls from raw 538 polls.
+
+    Renames the columns used later and tidies up the party and candidate
+    names.
+    """
+    # Renaming and tidying up data
+    # ----------------------------
+    # Rename columns - renaming any columns I need to merge on or
+    # that I alter in some way
+    polls = polls.rename(columns={'cycle': 'Year',
+                                  'candidate_party': 'Party',
+                                  'candidate_name': 'Candidate name',
+                                  'state': 'State name'})
+
+    # Change dataframe contents
+    replace_dict = [{'col': 'Party', 'old': 'DEM', 'new': 'Democratic'},
+                    {'col': 'Party', 'old': 'REP', 'new': 'Republican'},
+                    {'col': 'Candidate name',
+                     'old': 'Biden', 'new': 'Joe Biden'},
+                    {'col': 'Candidate name',
+                     'old': 'Trump', 'new': 'Donald Trump'}]
+    for replace in replace_dict:
+        polls.loc[polls[replace['col']].str.contains(replace['old']),
+                  replace['col']] = replace['new']
+
+    # Filtering - generic
+    # -------------------
+    # Filter for state polls, just Democratic and Republican and
+    # for just two named candidates
+    return polls[(~polls['State name'].isnull()) &
+                 (polls['Party'].isin(['Democratic', 'Republican'])) &
+                 (polls['Year'] == 2020) &
+                 (polls['Candidate name'].isin(['Donald Trump',
+                                                'Joe Biden']))]
+
+
+def save_frame(file, frame, key, message=''):
+    """Save a DataFrame as columns in a .npz file, with a key.
+
+    Text columns are saved as fixed width strings with a mask of missing
+    values, so no pickling is needed. The file is written under a
+    temporary name and renamed, so other processes never see a partial
+    file. message is saved alongside, e.g. an error found when building
+    the frame.
+    """
+    arrays = {'columns': np.array(frame.columns, dtype=str),
+              'columns_name': np.array(frame.columns.name or ''),
+              'key': np.array(key),
+              'message': np.array(message)}
+    for index, column in enumerate(frame.columns):
+        values = frame[column].to_numpy()
+        if values.dtype == object:
+            arrays['nulls{0}'.format(index)] = pd.isna(values)
+            values = np.where(pd.isna(values), '', values).astype(str)
+        arrays['column{0}'.format(index)] = values
+    _temporary = '{0}.{1}.tmp'.format(file, os.getpid())
+    with open(_temporary, 'wb') as npz:
+        np.savez(npz, **arrays)
+    os.replace(_temporary, file)
+
+
+def load_frame(file, key):
+    """Return the DataFrame and message saved with save_frame.
+
+    Returns None if there's no file, it was saved with a different key or
+    it can't be read, e.g. it's been corrupted.
+    """
+    if not os.path.isfile(file):
+        return None
+    try:
+        with np.load(file) as arrays:
+            if str(arrays['key']) != key:
+                return None
+            frame = {}
+            for index, column in enumerate(arrays['columns']):
+                values = arrays['column{0}'.format(index)]
+                if 'nulls{0}'.format(index) in arrays.files:
+                    values = values.astype(object)
+                    values[arrays['nulls{0}'.format(index)]] = np.nan
+                frame[column] = values
+            frame = pd.DataFrame(frame)
+            frame.columns.name = str(arrays['columns_name']) or None
+            return frame, str(arrays['message'])
+    except (OSError, EOFError, ValueError, KeyError, zipfile.BadZipFile):
+        return None
 
 
 # %%---------------------------------------------------------------------------
@@ -81,8 +284,16 @@ class Model():
         self.allocations = None
         self.results = None
         self.polls = None
+        self.exclusions = None
+        self.exclusions_version = None
         self.electoral = None
         self.state = None
+        self.run_summary = ''
+        # The year of the loaded forecast
+        self.year = None
+        # Electoral college model and per date product trees for scenarios
+        self._scenario_model = None
+        self._scenario_trees = OrderedDict()
 
     # %%
     @reset_error
@@ -134,52 +345,69 @@ class Model():
 
         # Polls
         # =====
-        # Using low memory because of warning - file is small enough
-        # this this is OK
-        self.polls = pd.read_csv(os.path.join(self.model_folder,
-                                              RAWDATA,
-                                              'Polls_2020.csv'),
-                                 parse_dates=['start_date',
-                                              'end_date'],
-                                 low_memory=False)
-
-        # Renaming and tidying up data
-        # ----------------------------
-        # Rename columns - renaming any columns I need to merge on or
-        # that I alter in some way
-        self.polls = (self.polls.rename(
-                        columns={'cycle': 'Year',
-                                 'candidate_party': 'Party',
-                                 'candidate_name': 'Candidate name',
-                                 'state': 'State name'}))
+        # Cleaning the raw polls is slow, so the cleaned polls are cached in
+        # a binary file keyed on the SHA-256 of the files they're made from.
+        # Changing any of them gives a new key, and the cache is rebuilt.
+        # Every source that's been fetched is cleaned together.
+        _polls_files = [os.path.join(self.model_folder,
+                                     RAWDATA,
+                                     source['file'])
+                        for source in POLL_SOURCES[2020]]
+        _polls_files = [file for file in _polls_files if os.path.isfile(file)]
+        if not _polls_files:
+            self.error_status = True
+            self.error_message = ("""No polls data files found, """
+                                  """use fetch_poll_sources to get them.""")
+            return
+        _names_file = os.path.join(self.model_folder,
+                                   RAWDATA,
+                                   'StateNames.csv')
+        _exclusions_file = os.path.join(self.model_folder,
+                                        RAWDATA,
+                                        'PollExclusions.csv')
+        self.exclusions, self.exclusions_version = read_exclusions(
+            _exclusions_file)
+        _key = file_hash(_polls_files + [_names_file, _exclusions_file],
+                         POLLS_CACHE_VERSION)
+        _cache = os.path.join(self.model_folder,
+                              PROCESSEDDATA,
+                              'polls_cache.npz')
+        _cached = load_frame(_cache, _key)
+        if _cached is not None:
+            self.polls, self.error_message = _cached
+            self.error_status = self.error_message != ''
+            return
+        self.clean_polls(_polls_files, names)
+        save_frame(_cache, self.polls, _key, self.error_message)
+
+    # %%
+    def clean_polls(self, polls_files, names):
+        """Read and clean the raw 538 polls in the polls files.
+
+        names is the state names and abbreviations. Leaves the cleaned
+        polls in self.polls, one row per poll question, with the
+        Democratic and Republican percentages and the spread.
+        """
+        # The raw file has every cycle and race and keeps growing, so it's
+        # read in chunks of just the columns used, and each chunk is cut
+        # down to the rows kept before the next is read. Memory use then
+        # depends on the rows kept, not the size of the file.
+        self.polls = pd.concat(
+            [filter_polls(chunk)
+             for polls_file in polls_files
+             for chunk in pd.read_csv(polls_file,
+                                      usecols=list(POLLS_COLUMNS),
+                                      dtype=POLLS_COLUMNS,
+                                      chunksize=POLLS_CHUNK_SIZE)],
+            ignore_index=True)
+        # Only the kept rows' dates are parsed
+        for column in ['start_date', 'end_date']:
+            self.polls[column] = pd.to_datetime(self.polls[column])
         # Add a state abbreviations column
         self.polls = self.polls.merge(names,
                                       on='State name',
                                       how='left')
 
-        # Change dataframe contents
-        replace_dict = [{'col': 'Party', 'old': 'DEM', 'new': 'Democratic'},
-                        {'col': 'Party', 'old': 'REP', 'new': 'Republican'},
-                        {'col': 'Candidate name',
-                         'old': 'Biden', 'new': 'Joe Biden'},
-                        {'col': 'Candidate name',
-                         'old': 'Trump', 'new': 'Donald Trump'}]
-        for replace in replace_dict:
-            self.polls.loc[
-                self.polls[
-                    replace['col']].str.contains(
-                        replace['old']), replace['col']] = replace['new']
-
-        # Filtering - generic
-        # -------------------
-        # Filter for state polls, just Democratic and Republican and
-        # for just two named candidates
-        self.polls = self.polls[(~self.polls['State name'].isnull()) &
-                                (self.polls['Party'].isin(['Democratic',
-                                                           'Republican'])) &
-                                (self.polls['Year'] == 2020) &
-                                (self.polls['Candidate name'].isin(
-                                    ['Donald Trump', 'Joe Biden']))]
         # Some polls are for hypothetical match ups and removing candidates who
         # didn't make the final ticket can leave us with odd results,
         # so we need to remove all surveys and questions where just one
@@ -200,280 +428,10 @@ class Model():
         # Filtering - poll specific
         # -------------------------
         # Some polls require qualification, e.g. the same results are
-        # presented in two or more seperate ways. We need to filter specific
-        # polls here.
-
-        # Higher and lower likelihood of turnout - some Monmouth
-        # polls report three variants - remove higher and lower variants
-        self.polls = self.polls[
-            ~(
-                (self.polls['poll_id'].isin([67821, 67101, 67920, 
-                                             69464])) &
-                (self.polls['notes'].isin(['lower likely turnout',
-                                           'higher likely turnout']))
-              )]
-        self.polls = self.polls[
-            ~(
-                (self.polls['poll_id'].isin([70599])) &
-                (self.polls['notes'].isin(['low likely turnout',
-                                           'high likely turnout']))
-              )]
-        self.polls = self.polls[
-            ~(
-                (self.polls['poll_id'].isin([70780])) &
-                (self.polls['notes'].isin(['low likely turnout',
-                                           'high likely turnout']))
-              )]
-        self.polls = self.polls[
-            ~(
-                (self.polls['poll_id'].isin([71090])) &
-                (self.polls['notes'].isin(['low turnout model',
-                                           'high turnout model']))
-              )]
-        self.polls = self.polls[
-            ~(
-                (self.polls['poll_id'].isin([71548])) &
-                (self.polls['notes'].isin(['lower turnout model',
-                                           'higher turnout model']))
-              )]
-        self.polls = self.polls[
-            ~(
-                (self.polls['poll_id'].isin([72146])) &
-                (self.polls['notes'].isin(['lower turnout model',
-                                           'higher turnout model']))
-              )]
-        self.polls = self.polls[
-            ~(
-                (self.polls['poll_id'].isin([72214])) &
-                (self.polls['notes'].isin(['higher turnout model',
-                                           'lower turnout model']))
-              )]
-        self.polls = self.polls[
-            ~(
-                (self.polls['poll_id'].isin([72599])) &
-                (self.polls['notes'].isin(['high likely turnout',
-                                           'low likley turnout']))
-              )]
-        # Arizona poll where first question is a head-to-head Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 70079) &
-                                  (self.polls['question_id'] == 130554))]
-        # Arizona poll where second question is a head-to-head Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 67934) &
-                                  (self.polls['question_id'] == 127187))]
-        # Arizona poll where first question is a head-to-head Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 71007) &
-                                  (self.polls['question_id'] == 132884))]
-        # Arizona poll where second question is a head-to-head Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 71067) &
-                                  (self.polls['question_id'] == 133042))]
-        # Arizona polls - removing higher and lower voter turnout
-        self.polls = self.polls[~((self.polls['poll_id'] == 69513) &
-                                  (self.polls['question_id'] == 129488))]
-        self.polls = self.polls[~((self.polls['poll_id'] == 69513) &
-                                  (self.polls['question_id'] == 129489))]
-        # Arizona poll where first question is a head-to-head Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 71621) &
-                                  (self.polls['question_id'] == 134170))]
-        # Arizona poll where second question is a head-to-head Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 71753) &
-                                  (self.polls['question_id'] == 134445))]
-        # Arizona poll where first question is a head-to-head Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 72166) &
-                                  (self.polls['question_id'] == 135353))]
-        # Arizona poll where first question is a head-to-head Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 72653) &
-                                  (self.polls['question_id'] == 136341))]
-        # Colorado poll where second question is a head-to-head Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 69433) &
-                                  (self.polls['question_id'] == 129320))]
-        # Florida poll where second question is a head-to-head Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 66308) &
-                                  (self.polls['question_id'] == 123433))]
-        # Florida poll where first question is a head-to-head Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 71006) &
-                                  (self.polls['question_id'] == 132883))]
-        # Florida poll where first question is a head-to-head Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 71620) &
-                                  (self.polls['question_id'] == 134168))]
-        # Florida poll where first question is a head-to-head Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 72167) &
-                                  (self.polls['question_id'] == 135354))]
-        # Florida poll where first question is a head-to-head Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 72658) &
-                                  (self.polls['question_id'] == 136351))]
-        # Georgia poll where second question lower/higher
-        self.polls = self.polls[~((self.polls['poll_id'] == 69690) &
-                                  (self.polls['question_id'] == 129931))]
-        self.polls = self.polls[~((self.polls['poll_id'] == 69690) &
-                                  (self.polls['question_id'] == 129932))]
-        # Georgia poll where second question is a head-to-head Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 69937) &
-                                  (self.polls['question_id'] == 130229))]
-        # Iowa poll where second question is a head-to-head Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 67935) &
-                                  (self.polls['question_id'] == 127189))]
-        # Iowa poll Monmouth poll
-        self.polls = self.polls[~((self.polls['poll_id'] == 69943) &
-                                  (self.polls['question_id'] == 130247))]
-        self.polls = self.polls[~((self.polls['poll_id'] == 70080) &
-                                  (self.polls['question_id'] == 130555))]
-        # Iowa poll where first question is a head-to-head Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 70080) &
-                                  (self.polls['question_id'] == 130554))]
-        # Kansas poll where second question is a head-to-head Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 69938) &
-                                  (self.polls['question_id'] == 130231))]
-        # Kentucky poll where second question is a head-to-head Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 69939) &
-                                  (self.polls['question_id'] == 130233))]
-        # Maine polls represent a challenge, for now, we'll just remove
-        # Congressional District polls
-        self.polls = self.polls[~self.polls['State name'].isin(
-            ['Maine CD-1', 'Maine CD-2'])]
-        # Maine poll where second question is a head-to-head Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 67936) &
-                                  (self.polls['question_id'] == 127191))]
-        # Maine poll where second question is a RCV Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 69587) &
-                                  (self.polls['question_id'] == 129679))]
-        # Maine poll where second question is a head-to-head Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 70081) &
-                                  (self.polls['question_id'] == 130559))]
-        # Michigan poll where question 123714 seems to exclude 3rd parties
-        self.polls = self.polls[~((self.polls['poll_id'] == 66406) &
-                                  (self.polls['question_id'] == 123714))]
-        # Michigan poll - 2nd option not clear
-        self.polls = self.polls[~((self.polls['poll_id'] == 57656) &
-                                  (self.polls['question_id'] == 93510))]
-        # Michigan poll - 2nd option not clear
-        self.polls = self.polls[~((self.polls['poll_id'] == 58192) &
-                                  (self.polls['question_id'] == 94749))]
-        # Michigan poll where second question is a head-to-head Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 69940) &
-                                  (self.polls['question_id'] == 130235))]
-        # Michigan poll where first question is a head-to-head Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 70785) &
-                                  (self.polls['question_id'] == 132430))]
-        # Michigan poll where first question is a head-to-head Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 71462) &
-                                  (self.polls['question_id'] == 133844))]
-        # Michigan poll where first question is a head-to-head Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 72058) &
-                                  (self.polls['question_id'] == 135091))]
-        # Michigan poll where first question is a head-to-head Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 72508) &
-                                  (self.polls['question_id'] == 136071))]
-        # Nebraska polls represent a challenge, for now, we'll just remove
-        # Congressional District polls
-        self.polls = self.polls[~self.polls['State name'].isin(
-            ['Nebraska CD-1', 'Nebraska CD-2'])]
-        # New Hampshire poll with two presentations
-        self.polls = self.polls[
-            ~((self.polls['poll_id'] == 62978) &
-              (self.polls['notes'] ==
-               'split sample without undecided option'))]
-        # New Hampshire poll where second question is a head-to-head
-        # Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 70045) &
-                                  (self.polls['question_id'] == 130469))] 
-        # North Carolina poll where second question is a head-to-head
-        # Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 67937) &
-                                  (self.polls['question_id'] == 127193))]
-        # North Carolina poll where second question is a head-to-head
-        # Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 68464) &
-                                  (self.polls['question_id'] == 128157))]
-        # North Carolina poll where second question is a head-to-head
-        # Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 69504) &
-                                  (self.polls['question_id'] == 129476))]        
-        # North Carolina poll where second question is a head-to-head
-        # Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 70044) &
-                                  (self.polls['question_id'] == 130467))] 
-        # North Carolina poll where first question is a head-to-head 
-        # Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 70786) &
-                                  (self.polls['question_id'] == 132431))]
-        # North Carolina poll where second question is a head-to-head
-        # Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 71441) &
-                                  (self.polls['question_id'] == 130467))]
-        # North Carolina poll where first question is a head-to-head
-        # Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 71463) &
-                                  (self.polls['question_id'] == 133846))]
-        # North Carolina poll where second question is a head-to-head
-        # Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 72059) &
-                                  (self.polls['question_id'] == 135092))]
-        # North Carolina poll where first question is a head-to-head
-        # Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 72659) &
-                                  (self.polls['question_id'] == 136352))]
-        # Pennsylvania poll where second question is a head-to-head
-        # Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 68264) &
-                                  (self.polls['question_id'] == 127878))]
-        # Pennsylvania poll where second question is a head-to-head
-        # Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 71441) &
-                                  (self.polls['question_id'] == 133794))]
-        self.polls = self.polls[~((self.polls['poll_id'] == 71441) &
-                                  (self.polls['question_id'] == 133793))]
-        # Pennsylvania poll where second question is a head-to-head
-        # Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 68319) &
-                                  (self.polls['question_id'] == 127966))]
-        # Pennsylvania poll where 2nd question is a head-to-head 
-        # Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 70741) &
-                                  (self.polls['question_id'] == 132339))]
-        # Pennsylvania poll where 1st question is a head-to-head 
-        # Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 71379) &
-                                  (self.polls['question_id'] == 133664))]
-        # Pennsylvania poll where 1st question is a head-to-head 
-        # Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 71976) &
-                                  (self.polls['question_id'] == 134925))]
-        # Pennsylvania poll where 1st question is a head-to-head 
-        # Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 72507) &
-                                  (self.polls['question_id'] == 136069))]
-        # South Carolina poll where second question is a head-to-head
-        # Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 70082) &
-                                  (self.polls['question_id'] == 130561))]
-        # Texas poll where second question is a head-to-head
-        # Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 70046) &
-                                  (self.polls['question_id'] == 130471))]    
-        # # Utah poll - use UCEP educational model for now
-        self.polls = self.polls[
-            ~((self.polls['poll_id'] == 66525)
-              & ((self.polls['notes'].isin(
-                  ['CNN education weighting',
-                   'CPS education weighting',
-                   'CCES education weighting']))
-                  | (self.polls['notes'].isna())))]
-        # Wisconsin poll - 2nd option not clear
-        self.polls = self.polls[~((self.polls['poll_id'] == 57697) &
-                                  (self.polls['question_id'] == 93617))]
-        # Wisconsin poll where 2nd question is a head-to-head Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 70740) &
-                                  (self.polls['question_id'] == 132338))]
-        # Wisconsin poll where 1st question is a head-to-head Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 71380) &
-                                  (self.polls['question_id'] == 133665))]
-        # Wisconsin poll where 2nd question is a head-to-head Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 71975) &
-                                  (self.polls['question_id'] == 134924))]
-        # Wisconsin poll where 1st question is a head-to-head Trump vs. Biden
-        self.polls = self.polls[~((self.polls['poll_id'] == 72505) &
-                                  (self.polls['question_id'] == 136066))]
-
+        # presented in two or more seperate ways. The poll variants to remove
+        # are listed with reasons in PollExclusions.csv and removed in one
+        # pass.
+        self.polls = exclude_polls(self.polls, self.exclusions)
 
         # Filtering - population type
         # ---------------------------
@@ -552,8 +510,12 @@ class Model():
 
     # %%
     @reset_error
-    def get_years(self):
-        """Get the years for which we have data or have run analysis."""
+    def get_years(self, lazy=False):
+        """Get the years for which we have data or have run analysis.
+
+        A year's analysis needs its electoral_distribution_{year}.npz file
+        unless lazy is True, as load_forecast(lazy=True) doesn't read it.
+        """
         years = {'summary': [],
                  'allocations': [],
                  'results': [],
@@ -588,12 +550,15 @@ class Model():
         _files = [file.split('/')[-1] for file in
                   glob.glob(os.path.join(self.model_folder,
                                          PROCESSEDDATA,
-                                         r'*.csv'))]
+                                         r'*.*'))]
         _years = set([file[-8:-4] for file in _files])
         years['analysis'] =\
             [int(year) for year in _years
              if 'electoral_maximum_{0}.csv'.format(year) in _files
-             and 'electoral_distribution_{0}.csv'.format(year) in _files
+             and 'electoral_summary_{0}.csv'.format(year) in _files
+             and 'tipping_point_{0}.csv'.format(year) in _files
+             and (lazy
+                  or 'electoral_distribution_{0}.npz'.format(year) in _files)
              and 'state_{0}.csv'.format(year) in _files
              and 'processed_polls_{0}.csv'.format(year) in _files]
         return years
@@ -681,54 +646,182 @@ class Model():
 
     # %%
     @reset_error
-    def fetch_polls(self, year):
-        """Fetch polling data from 538."""
-        if year == 2020:
-            url = ("""https://projects.fivethirtyeight.com"""
-                   """/polls-page/president_polls.csv""")
-            request = requests.get(url)
-            if request.status_code != 200:
-                self.error_status = True
-                self.error_message = ("""model.fetch_polls returned """
-                                      """an error code of {0}."""
-                                      .format(request.status_code))
-                return
-            with open(os.path.join(self.model_folder,
-                                   RAWDATA,
-                                   "polls_2020.csv"),
-                      "wb") as poll_file:
-                poll_file.write(request.content)
+    def fetch_polls(self, year, url=POLLS_URL):
+        """Fetch polling data from 538, returning True if it's changed.
+
+        Only downloads the file if it's changed since the last fetch, see
+        fetch.fetch_file.
+        """
+        if year != 2020:
+            return False
+        try:
+            return fetch_file(url,
+                              os.path.join(self.model_folder,
+                                           RAWDATA,
+                                           'Polls_2020.csv'))
+        except requests.HTTPError as error:
+            self.error_status = True
+            self.error_message = ("""model.fetch_polls returned """
+                                  """an error code of {0}."""
+                                  .format(error.response.status_code))
+        except (requests.RequestException, OSError) as error:
+            self.error_status = True
+            self.error_message = ("""model.fetch_polls failed with {0}."""
+                                  .format(error))
+        return False
 
     # %%
     @reset_error
-    def calculate_forecast(self, year):
-        """Forecast the results of the Presidential election."""
+    async def fetch_poll_sources_async(self, year, workers=FETCH_WORKERS):
+        """Fetch all the year's POLL_SOURCES at the same time.
+
+        Runs on the caller's event loop, e.g. from a Bokeh server
+        callback, so the server keeps working while the sources download.
+        Returns a dict of each source's name and True if its file changed.
+        Sources that fail are False and are listed in the error message;
+        the others are still fetched.
+        """
+        _results = await fetch_sources(
+            POLL_SOURCES.get(year, []),
+            os.path.join(self.model_folder, RAWDATA),
+            workers)
+        _failed = {name: result for name, result in _results.items()
+                   if isinstance(result, Exception)}
+        if _failed:
+            self.error_status = True
+            self.error_message = (
+                """model.fetch_poll_sources failed for {0}."""
+                .format('; '.join('{0}: {1}'.format(name, error)
+                                  for name, error in _failed.items())))
+        return {name: result is True for name, result in _results.items()}
+
+    # %%
+    @reset_error
+    def fetch_poll_sources(self, year, workers=FETCH_WORKERS):
+        """Fetch all the year's POLL_SOURCES, for scripts.
+
+        Runs fetch_poll_sources_async on its own event loop and waits for
+        it. Code already on an event loop, like the Bokeh server, should
+        await fetch_poll_sources_async instead.
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self.fetch_poll_sources_async(year, workers))
+        self.error_status = True
+        self.error_message = ("""model.fetch_poll_sources can't run on an """
+                              """event loop, await """
+                              """fetch_poll_sources_async instead.""")
+        return {}
+
+    # %%
+    @reset_error
+    def calculate_forecast(self,
+                           year,
+                           incremental=False,
+                           fill_method='linear',
+                           workers=1,
+                           engine='direct',
+                           export_csv=False,
+                           correlated=False):
+        """Forecast the results of the Presidential election.
+
+        If incremental is True and there's a previous forecast for the year
+        made with the same fill_method, the state model is only
+        recalculated where the polls have changed.
+        fill_method is how the state model fills the days between polls,
+        see StateModel.
+        engine is how the electoral college model works out distributions,
+        see ElectoralCollegeModel. If correlated is True, the electoral
+        college is simulated with correlated state polling errors instead,
+        see SimulationModel.
+        workers is the number of processes the state model splits the poll
+        medians across and, if correlated is True, the number the
+        simulation's chunks run in. A process pool only pays for its start
+        up on a host with that many cores; on one core it's slower than
+        workers=1.
+        The electoral college distribution is saved as an ElectoralStore in
+        electoral_distribution_{year}.npz. If export_csv is True, it's also
+        written in long format to electoral_distribution_{year}.csv.
+        """
+        _state_file = os.path.join(self.model_folder,
+                                   PROCESSEDDATA,
+                                   'state_{0}.csv'.format(year))
+        _polls_file = os.path.join(self.model_folder,
+                                   PROCESSEDDATA,
+                                   'processed_polls_{0}.csv'.format(year))
+        # The settings the state forecast was made with
+        _settings_file = os.path.join(self.model_folder,
+                                      PROCESSEDDATA,
+                                      'state_{0}.json'.format(year))
+        _settings = {'fill_method': fill_method}
+
         # State model
         # ===========
         # Build the state model
         statemodel = StateModel(results=self.results,
                                 polls=self.polls,
-                                election_year=year)
+                                election_year=year,
+                                fill_method=fill_method,
+                                workers=workers)
         # Sets up more risky intialization that might fail
         statemodel.setup()
-        # Calculates the state-level model
-        statemodel.update()
+        # Calculates the state-level model, either from scratch or by
+        # updating the previous forecast with the polls that have changed
+        # since it was run. A forecast made with other settings, or with no
+        # record of them, is rebuilt from scratch.
+        _previous_settings = None
+        if os.path.isfile(_settings_file):
+            with open(_settings_file) as settings:
+                _previous_settings = json.load(settings)
+        if (incremental
+                and _previous_settings == _settings
+                and os.path.isfile(_state_file)
+                and os.path.isfile(_polls_file)):
+            # Round trip float parsing so unchanged polls compare equal.
+            _previous_polls = pd.read_csv(_polls_file,
+                                          parse_dates=['start_date',
+                                                       'end_date'],
+                                          float_precision='round_trip')
+            statemodel.update_incremental(
+                previous=pd.read_csv(_state_file,
+                                     parse_dates=['Date'],
+                                     float_precision='round_trip'),
+                changed=poll_delta(_previous_polls, self.polls))
+        else:
+            statemodel.update()
 
         # Write the state data to disk
-        statemodel.state.to_csv(os.path.join(self.model_folder,
-                                             PROCESSEDDATA,
-                                             'state_{0}.csv'.format(year)),
-                                index=False)
+        statemodel.state.to_frame().to_csv(_state_file, index=False)
+        with open(_settings_file, 'w') as settings:
+            json.dump(_settings, settings)
 
         # Electoral college data
         # ======================
         # Now build the electoral college forecast model
-        electoralmodel = ElectoralCollegeModel(state=statemodel.state,
-                                               allocations=self.allocations,
-                                               election_year=year)
+        if correlated:
+            electoralmodel = SimulationModel(state=statemodel.state,
+                                             allocations=self.allocations,
+                                             election_year=year,
+                                             workers=workers)
+        else:
+            electoralmodel = ElectoralCollegeModel(
+                state=statemodel.state,
+                allocations=self.allocations,
+                election_year=year,
+                engine=engine)
         electoralmodel.setup()
         # Calculates the electoral college model
         electoralmodel.update()
+        self.run_summary = (
+            "Electoral college: {0} of {1} dates recomputed ({2} in full, "
+            "{3} from the day before), {4} reused."
+            .format(electoralmodel.recomputed['full']
+                    + electoralmodel.recomputed['partial'],
+                    len(electoralmodel.distribution),
+                    electoralmodel.recomputed['full'],
+                    electoralmodel.recomputed['partial'],
+                    electoralmodel.recomputed['reused']))
 
         # Write the electoral college data to disk
         electoralmodel.electoral_maximum.to_csv(
@@ -736,26 +829,47 @@ class Model():
                          PROCESSEDDATA,
                          'electoral_maximum_{0}.csv'.format(year)),
             index=False)
-        electoralmodel.electoral_distribution.to_csv(
+        electoralmodel.electoral_summary.to_csv(
+            os.path.join(self.model_folder,
+                         PROCESSEDDATA,
+                         'electoral_summary_{0}.csv'.format(year)),
+            index=False)
+        electoralmodel.tipping_point().to_csv(
             os.path.join(self.model_folder,
                          PROCESSEDDATA,
-                         'electoral_distribution_{0}.csv'.format(year)),
+                         'tipping_point_{0}.csv'.format(year)),
             index=False)
+        electoralmodel.electoral_distribution.save(
+            os.path.join(self.model_folder,
+                         PROCESSEDDATA,
+                         'electoral_distribution_{0}.npz'.format(year)))
+        if export_csv:
+            electoralmodel.electoral_distribution.to_frame().to_csv(
+                os.path.join(self.model_folder,
+                             PROCESSEDDATA,
+                             'electoral_distribution_{0}.csv'.format(year)),
+                index=False)
 
         # Polling data
         # ============
         # Not really a forecast, but this is a convenient place to write
         # the cleaned up polling data to disk.
-        self.polls.to_csv(
-            os.path.join(self.model_folder,
-                         PROCESSEDDATA,
-                         'processed_polls_{0}.csv'.format(year)),
-            index=False)
+        self.polls.to_csv(_polls_file, index=False)
 
     # %%
     @reset_error
-    def load_forecast(self, year):
-        """Read in the forecast data, if present."""
+    def load_forecast(self, year, lazy=False, cache_size=32, prefetch=1):
+        """Read in the forecast data, if present.
+
+        If lazy is True, the electoral college distribution isn't read,
+        each date's distribution is worked out from the state forecast
+        when it's looked up and kept in a cache of cache_size dates, see
+        LazyElectoralStore.
+        """
+        self.year = year
+        self._scenario_model = None
+        self._scenario_trees = OrderedDict()
+
         # Electoral college
         # =================
         self.electoral_maximum = pd.read_csv(
@@ -763,26 +877,50 @@ class Model():
                          PROCESSEDDATA,
                          'electoral_maximum_{0}.csv'.format(year)),
             parse_dates=['Date'])
-        self.electoral_distribution = pd.read_csv(
+        self.electoral_summary = pd.read_csv(
             os.path.join(self.model_folder,
                          PROCESSEDDATA,
-                         'electoral_distribution_{0}.csv'.format(year)),
+                         'electoral_summary_{0}.csv'.format(year)),
+            parse_dates=['Date'])
+        self.tipping_point = pd.read_csv(
+            os.path.join(self.model_folder,
+                         PROCESSEDDATA,
+                         'tipping_point_{0}.csv'.format(year)),
             parse_dates=['Date'])
 
         # State forecasts
         # ===============
-        self.state = pd.read_csv(
+        self.state = StateStore.from_frame(pd.read_csv(
             os.path.join(self.model_folder,
                          PROCESSEDDATA,
                          'state_{0}.csv'.format(year)),
-            parse_dates=['Date'])
+            parse_dates=['Date']))
         _names = pd.read_csv(os.path.join(self.model_folder,
                                           RAWDATA,
                                           'StateNames.csv'))
         # Add in the State names - makes it easier to display results
-        self.state = self.state.merge(_names,
-                                      on='State abbreviation',
-                                      how='left')
+        self.state.names = (_names.set_index('State abbreviation')
+                            ['State name']
+                            .reindex(self.state.states)
+                            .to_numpy())
+
+        # Electoral college distribution
+        # ==============================
+        if lazy:
+            electoralmodel = ElectoralCollegeModel(
+                state=self.state,
+                allocations=self.allocations,
+                election_year=year)
+            electoralmodel.setup()
+            self.electoral_distribution = electoralmodel.lazy_distribution(
+                cache_size=cache_size,
+                prefetch=prefetch)
+        else:
+            self.electoral_distribution = ElectoralStore.load(
+                os.path.join(self.model_folder,
+                             PROCESSEDDATA,
+                             'electoral_distribution_{0}.npz'.format(year)))
+
         # Polls
         # =====
         # Not really a forecast, but the processed polling data is used
@@ -800,6 +938,151 @@ class Model():
         start_date = pd.to_datetime('{0}-01-01'.format(year))
         self.polls = self.polls[self.polls['end_date'] >= start_date]
 
+    # %%
+    def _scenario_states(self, date):
+        """Return the electoral college model and the date's state data.
+
+        The state data are the date's column, Spread D-R and Observations,
+        in the electoral college model's state order. States with no polls
+        yet get the sample size given to the previous election's result.
+        Returns None if no forecast has been loaded or there's no forecast
+        for the date.
+        """
+        if self.state is None or self.allocations is None:
+            self.error_status = True
+            self.error_message = ("No forecast to work out the scenario "
+                                  "from, read the raw data and load a "
+                                  "forecast first.")
+            return None
+        if self._scenario_model is None:
+            self._scenario_model = ElectoralCollegeModel(
+                state=self.state,
+                allocations=self.allocations,
+                election_year=self.year)
+            self._scenario_model.setup()
+        _rows = self._scenario_model.rows
+        _column = self.state.date_index(date)
+        if not 0 <= _column < len(self.state.dates):
+            self.error_status = True
+            self.error_message = (
+                "No forecast for {0}, the forecast runs from {1} to {2}."
+                .format(pd.Timestamp(date).date(),
+                        self.state.dates[0].date(),
+                        self.state.dates[-1].date()))
+            return None
+        _spread = self.state['Spread D-R'][_rows, _column]
+        _observations = self.state['Observations'][_rows, _column]
+        _observations = np.where(np.isnan(_observations),
+                                 SEED_OBSERVATIONS,
+                                 _observations)
+        return self._scenario_model, _column, _spread, _observations
+
+    # %%
+    @reset_error
+    def swing_curve(self, date, swings):
+        """Return the electoral college forecast for uniform swings.
+
+        Each swing is added to every state's Spread D-R on the date, so
+        0.01 moves every state one point towards the Democrats. Between
+        polls the forecast interpolates the win probabilities, not the
+        spreads and sample sizes, so each state starts from its forecast
+        win probability's z-score and moves by the change in
+        spread/sigma the swing makes. A zero swing gives the forecast on
+        every date. The win probabilities for all the states and swings
+        are worked out at once and the electoral college distributions for
+        all the swings in one batch. Returns the expected Democratic
+        electoral college votes and the probability of a Democratic
+        majority for each swing, or None if no forecast has been loaded or
+        there's no forecast for the date.
+        """
+        _scenario = self._scenario_states(date)
+        if _scenario is None:
+            return None
+        electoralmodel, _column, _spread, _observations = _scenario
+        _z = np.clip(scipy.special.ndtri(
+            self.state['Democratic probability'][electoralmodel.rows,
+                                                 _column]),
+                     -SWING_Z_LIMIT, SWING_Z_LIMIT)
+
+        # (swings x states) win probabilities
+        _swings = np.asarray(swings, dtype=float)
+        _swung = np.clip(_spread + _swings[:, np.newaxis], -1, 1)
+        _probabilities = scipy.special.ndtr(
+            _z
+            + _swung/sigma(_swung, _observations)
+            - _spread/sigma(_spread, _observations))
+        _distribution = electoral_distribution(_probabilities,
+                                               electoralmodel.allocation)
+
+        _votes = _distribution.shape[1] - 1
+        return pd.DataFrame(
+            {'Swing': _swings,
+             'Democratic expected votes':
+                 _distribution @ np.arange(_votes + 1),
+             'Democratic win probability':
+                 _distribution[:, _votes//2 + 1:].sum(axis=1)})
+
+    # %%
+    @reset_error
+    def what_if(self, date, pins=None, spreads=None):
+        """Return the electoral college distribution for a scenario.
+
+        pins maps state abbreviations to the party that wins them and
+        spreads maps state abbreviations to a new Spread D-R. Every other
+        state keeps its forecast for the date. Each date's states are held
+        in a product tree, so only the overridden states are re-convolved;
+        the trees for the last SCENARIO_DATES dates are kept. Returns the
+        parties' distributions indexed by electoral college vote, or None
+        if no forecast has been loaded, there's no forecast for the date or
+        a state or party is unknown.
+        """
+        pins = {} if pins is None else pins
+        spreads = {} if spreads is None else spreads
+        _scenario = self._scenario_states(date)
+        if _scenario is None:
+            return None
+        electoralmodel, _column, _spread, _observations = _scenario
+        _states = list(self.state.states[electoralmodel.rows])
+
+        _probabilities = self.state['Democratic probability'][
+            electoralmodel.rows, _column].copy()
+        for abbreviation, spread in spreads.items():
+            if abbreviation not in _states:
+                self.error_status = True
+                self.error_message = ("Unknown state '{0}' in the scenario."
+                                      .format(abbreviation))
+                return None
+            _index = _states.index(abbreviation)
+            _probabilities[_index] = win_prob(np.clip(spread, -1, 1),
+                                              _observations[_index])
+        for abbreviation, party in pins.items():
+            if abbreviation not in _states or party not in PARTIES:
+                self.error_status = True
+                self.error_message = ("Can't pin '{0}' to '{1}' in the "
+                                      "scenario.".format(abbreviation, party))
+                return None
+            _probabilities[_states.index(abbreviation)] = \
+                1.0 if party == 'Democratic' else 0.0
+
+        # The tree still holds the date's last scenario, setting the new
+        # probabilities only changes the states that differ.
+        if _column in self._scenario_trees:
+            self._scenario_trees.move_to_end(_column)
+        else:
+            self._scenario_trees[_column] = ProductTree(
+                electoralmodel.allocation)
+            if len(self._scenario_trees) > SCENARIO_DATES:
+                self._scenario_trees.popitem(last=False)
+        _tree = self._scenario_trees[_column]
+        _tree.set(_probabilities)
+
+        _distribution = _tree.distribution
+        return pd.DataFrame(
+            {'Democratic distribution': _distribution,
+             'Republican distribution': _distribution[::-1]},
+            index=pd.RangeIndex(len(_distribution),
+                                name='Electoral college vote'))
+
 
 # %%
 # Code to test the model
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Project: silkworm.
+
+Description:
+Silkworm is a poll-based US Presidential Election forecaster.
+
+Author: Mike Woodward
+
+Created on: 2020-07-26
+
+"""
+
+# %%---------------------------------------------------------------------------
+# Module metadata
+# -----------------------------------------------------------------------------
+__author__ = "Mike Woodward"
+__license__ = "MIT"
+
+
+# %%---------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+import numpy as np
+
+
+# %%---------------------------------------------------------------------------
+# ProductTree
+# -----------------------------------------------------------------------------
+class ProductTree():
+    """Balanced product tree of the states' generator polynomials.
+
+    The leaves are each state's polynomial (1 - p) + p x^allocation and
+    every internal node caches the convolution of its two children, so the
+    root is the electoral college vote distribution. Changing one state's
+    probability only re-convolves the nodes on its path to the root,
+    about log2(states) of them, rather than all the states.
+
+    The tree is stored as an array: node i has children 2i and 2i + 1, the
+    leaves are nodes states..2*states - 1 and the root is node 1.
+    """
+
+    # %%
+    def __init__(self, allocation):
+        """Initialize with the states' electoral college votes."""
+        self.allocation = np.asarray(allocation, dtype=int)
+        self.size = len(self.allocation)
+        self.depth = int(np.ceil(np.log2(2*self.size)))
+        self.probabilities = np.full(self.size, np.nan)
+        self.nodes = [np.ones(1)]*(2*self.size)
+
+    # %%
+    def _leaf(self, state):
+        """Return a state's generator polynomial."""
+        polynomial = np.zeros(self.allocation[state] + 1)
+        polynomial[0] += 1 - self.probabilities[state]
+        polynomial[-1] += self.probabilities[state]
+        return polynomial
+
+    # %%
+    def set(self, probabilities):
+        """Set the states' win probabilities, updating what's changed.
+
+        Only the leaves whose probability changed and their ancestors are
+        recalculated. If so many changed that that's more work than
+        building the tree from scratch, the whole tree is rebuilt.
+        """
+        probabilities = np.asarray(probabilities, dtype=float)
+        changed = np.flatnonzero(probabilities != self.probabilities)
+        self.probabilities = probabilities.copy()
+        if len(changed)*self.depth >= self.size:
+            changed = np.arange(self.size)
+            ancestors = range(self.size - 1, 0, -1)
+        else:
+            ancestors = set()
+            for node in changed + self.size:
+                while node > 1:
+                    node //= 2
+                    ancestors.add(node)
+            # Children have higher indexes than their parents, so going
+            # from high to low updates children first.
+            ancestors = sorted(ancestors, reverse=True)
+
+        for state in changed:
+            self.nodes[state + self.size] = self._leaf(state)
+        for node in ancestors:
+            self.nodes[node] = np.convolve(self.nodes[2*node],
+                                           self.nodes[2*node + 1])
+
+    # %%
+    @property
+    def distribution(self):
+        """Return the distribution of votes won, indexed by votes."""
+        return self.nodes[1]
+
+
+# %%
+# Code to benchmark the product tree
+if __name__ == "__main__":
+
+    import os
+    import time
+
+    import pandas as pd
+
+    _allocation = pd.read_csv(
+        os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                     'rawdata',
+                     'ElectoralCollegeAllocations.csv'))['2020'].to_numpy()
+    _rng = np.random.default_rng(0)
+    _probabilities = _rng.random(51)
+    _repeats = 200
+
+    # The generator polynomial np.convolve chain over all the states
+    _start = time.perf_counter()
+    for _ in range(_repeats):
+        _chain = [1]
+        for _p, _a in zip(_probabilities, _allocation):
+            _chain = np.convolve(_chain, [1 - _p] + [0]*(_a - 1) + [_p])
+    _elapsed_chain = (time.perf_counter() - _start)/_repeats
+
+    # Changing one state in the product tree
+    _tree = ProductTree(_allocation)
+    _tree.set(_probabilities)
+    _start = time.perf_counter()
+    for _repeat in range(_repeats):
+        _probabilities[_repeat % 51] = _rng.random()
+        _tree.set(_probabilities)
+    _elapsed_tree = (time.perf_counter() - _start)/_repeats
+
+    _chain = [1]
+    for _p, _a in zip(_probabilities, _allocation):
+        _chain = np.convolve(_chain, [1 - _p] + [0]*(_a - 1) + [_p])
+    print("Full np.convolve chain: {0:8.1f}us".format(1e6*_elapsed_chain))
+    print("One state changed in the tree: {0:8.1f}us"
+          .format(1e6*_elapsed_tree))
+    print("Maximum difference: {0}"
+          .format(np.abs(_chain - _tree.distribution).max()))
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Project: silkworm.
+
+Description:
+Silkworm is a poll-based US Presidential Election forecaster.
+
+Author: Mike Woodward
+
+Created on: 2020-07-26
+
+"""
+
+# %%---------------------------------------------------------------------------
+# Module metadata
+# -----------------------------------------------------------------------------
+__author__ = "Mike Woodward"
+__license__ = "MIT"
+
+
+# %%---------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+import scipy.special
+# try-except to handle execution as a standalone and as part of Bokeh
+# application
+try:
+    from model.electoralcollegemodel import ElectoralCollegeModel
+    from model.statemodel import SEED_OBSERVATIONS, sigma
+except ModuleNotFoundError:
+    from electoralcollegemodel import ElectoralCollegeModel
+    from statemodel import SEED_OBSERVATIONS, sigma
+
+
+# %%---------------------------------------------------------------------------
+# Constants
+# -----------------------------------------------------------------------------
+# US Census regions, states in the same region share a polling error.
+REGIONS = {
+    'Northeast': ['CT', 'MA', 'ME', 'NH', 'NJ', 'NY', 'PA', 'RI', 'VT'],
+    'Midwest': ['IA', 'IL', 'IN', 'KS', 'MI', 'MN', 'MO', 'ND', 'NE', 'OH',
+                'SD', 'WI'],
+    'South': ['AL', 'AR', 'DC', 'DE', 'FL', 'GA', 'KY', 'LA', 'MD', 'MS',
+              'NC', 'OK', 'SC', 'TN', 'TX', 'VA', 'WV'],
+    'West': ['AK', 'AZ', 'CA', 'CO', 'HI', 'ID', 'MT', 'NM', 'NV', 'OR', 'UT',
+             'WA', 'WY']}
+
+
+# %%---------------------------------------------------------------------------
+# Functions
+# -----------------------------------------------------------------------------
+@lru_cache(maxsize=16)
+def shared_loadings(states, national, regional):
+    """Return the loadings of the states' shared spread errors.
+
+    states is a tuple of state abbreviations. Column 0 is a national error
+    shared by every state, with standard deviation national, and the
+    other columns are a regional error for each of the REGIONS, with
+    standard deviation regional. A state's shared error is its row times
+    independent standard normal draws. Cached, because it only depends on
+    the arguments.
+    """
+    _region = {abbreviation: region
+               for region, abbreviations in REGIONS.items()
+               for abbreviation in abbreviations}
+    regions = [_region.get(abbreviation, abbreviation)
+               for abbreviation in states]
+    _names = sorted(set(regions))
+    loadings = np.zeros((len(states), 1 + len(_names)))
+    loadings[:, 0] = national
+    loadings[np.arange(len(states)),
+             1 + np.searchsorted(_names, regions)] = regional
+    return loadings
+
+
+def simulate(spreads, scales, allocation, loadings, simulations, seed):
+    """Return the vote total counts from simulating every date.
+
+    spreads is the (dates x states) Democratic spread, scales the
+    (dates x states) standard deviation of each state's own spread error,
+    allocation the states' electoral college votes and loadings the
+    states' shared error loadings, see shared_loadings. Draws simulations
+    shared and state errors from the seed and applies the same draws to
+    every date, so the day to day changes come from the polls, not from
+    the draws. Returns the (dates x votes) number of simulations that gave
+    each vote total.
+    """
+    rng = np.random.default_rng(seed)
+    # float32 halves the memory traffic and lets the vote count be a BLAS
+    # matrix-vector product; totals are at most 538 so they're exact.
+    shared = (rng.standard_normal((simulations, loadings.shape[1]))
+              @ loadings.T).astype(np.float32)
+    noise = rng.standard_normal((simulations, len(allocation)),
+                                dtype=np.float32)
+    errors = np.empty(noise.shape, dtype=np.float32)
+    weights = allocation.astype(np.float32)
+    won = np.empty(noise.shape, dtype=bool)
+    votes = allocation.sum()
+    counts = np.empty((len(spreads), votes + 1), dtype=np.int64)
+    for index, spread in enumerate(spreads):
+        np.multiply(noise, scales[index].astype(np.float32), out=errors)
+        errors += shared
+        np.greater(errors, -spread.astype(np.float32), out=won)
+        counts[index] = np.bincount(
+            (won.astype(np.float32) @ weights).astype(np.int64),
+            minlength=votes + 1)
+    return counts
+
+
+def _simulate(chunk):
+    """Process pool wrapper for simulate."""
+    return simulate(*chunk)
+
+
+# %%---------------------------------------------------------------------------
+# SimulationModel
+# -----------------------------------------------------------------------------
+class SimulationModel(ElectoralCollegeModel):
+    """Models the electoral college with correlated state polling errors.
+
+    The electoral college model treats the states as independent, so a
+    polling miss in one state says nothing about its neighbours. Here each
+    simulation draws state spread errors with national and regional parts
+    shared between states and a part for each state, adds them to the
+    state spreads and counts the votes won. A state's own error is its
+    sampling error from the state model, sigma(spread, observations),
+    plus an optional extra error, so with no national, regional or extra
+    error the simulation gives the electoral college model's
+    distribution. The simulations run in chunks, each with its own seed
+    from one SeedSequence, so results only depend on seed and
+    chunk_size, however many workers run the chunks.
+    """
+
+    # %%
+    def __init__(self,
+                 state,
+                 allocations,
+                 election_year,
+                 simulations=100000,
+                 national=0.03,
+                 regional=0.02,
+                 state_error=0.0,
+                 chunk_size=10000,
+                 seed=0,
+                 workers=1):
+        """Initialize.
+
+        national and regional are the standard deviations of the shared
+        spread errors, see shared_loadings, and state_error the standard
+        deviation of an extra error for each state on top of its sampling
+        error.
+        """
+        super().__init__(state=state,
+                         allocations=allocations,
+                         election_year=election_year)
+        self.simulations = simulations
+        self.national = national
+        self.regional = regional
+        self.state_error = state_error
+        self.chunk_size = chunk_size
+        self.seed = seed
+        self.workers = workers
+
+    # %%
+    def update(self):
+        """Update the electoral college forecast by simulation."""
+        _loadings = shared_loadings(tuple(self.state.states[self.rows]),
+                                    self.national,
+                                    self.regional)
+        # Each state's sampling error, states with no polls yet get the
+        # sample size given to the previous election's result.
+        _observations = self.state['Observations'][self.rows].T
+        _sigma = sigma(self.state['Spread D-R'][self.rows].T,
+                       np.where(np.isnan(_observations),
+                                SEED_OBSERVATIONS,
+                                _observations))
+        # Between polls the forecast interpolates the win probabilities, so
+        # the spread used is the one that gives the forecast win probability
+        # with the state's sigma. On poll dates it's Spread D-R.
+        _spreads = scipy.special.ndtri(
+            self.state['Democratic probability'][self.rows].T)*_sigma
+        _scales = np.sqrt(_sigma**2 + self.state_error**2)
+        _sizes = [min(self.chunk_size, self.simulations - start)
+                  for start in range(0, self.simulations, self.chunk_size)]
+        _seeds = np.random.SeedSequence(self.seed).spawn(len(_sizes))
+        _chunks = [(_spreads, _scales, self.allocation, _loadings, size, seed)
+                   for size, seed in zip(_sizes, _seeds)]
+
+        if self.workers > 1:
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                _counts = sum(executor.map(_simulate, _chunks))
+        else:
+            _counts = sum(map(_simulate, _chunks))
+
+        self.distribution = _counts/self.simulations
+        self.recomputed = {'full': len(self.distribution),
+                           'partial': 0,
+                           'reused': 0}
+        self.summarize()
@@ -22,16 +22,32 @@ __license__ = "MIT"
 # %%---------------------------------------------------------------------------
 # Imports
 # -----------------------------------------------------------------------------
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import pandas as pd
 import numpy
 import scipy
 import scipy.special
+# try-except to handle execution as a standalone and as part of Bokeh
+# application
+try:
+    from model.statestore import METRICS, StateStore
+except ModuleNotFoundError:
+    from statestore import METRICS, StateStore
 
 # %%---------------------------------------------------------------------------
 # Constants
 # -----------------------------------------------------------------------------
 CONFIDENCE95 = 1.96
+# This is the poll aggregation window size, but because we use <= and >=,
+# it's actually the window size -1. This is a safer implementation.
+WINDOW = 6
+# Sample size given to the previous election's result, which seeds every
+# state's forecast.
+SEED_OBSERVATIONS = 100
+# Ways of filling the days between poll medians, see fill_gaps.
+FILL_METHODS = ['linear', 'previous', 'pchip']
 
 
 # %%---------------------------------------------------------------------------
@@ -52,6 +68,322 @@ def win_prob(spread, observations):
         spread/(numpy.sqrt(2.0)*sigma(spread, observations))))
 
 
+def window_medians(codes,
+                   days,
+                   spread,
+                   sample_size,
+                   democratic,
+                   republican,
+                   window):
+    """Return the median poll of every rolling window as arrays.
+
+    The polls must be sorted by state code and then by day. Each state's
+    windows end on its poll days and on its poll days + window, which
+    catches the corner case of two polls on adjacent days. A window ending
+    on day d holds the polls with d - window <= day <= d.
+
+    Rather than slicing and sorting a frame for every window, the polls are
+    keyed by (state, day) so one searchsorted call gives every window's
+    bounds. The windows are laid out as the rows of a padded matrix and
+    sorted by spread in one go. The stable sort keeps polls with the same
+    spread in date order, so the median sample size and proportions are
+    the ones a per-window sort would pick.
+    """
+    if len(days) == 0:
+        return {'code': np.empty(0, dtype=np.int64),
+                'day': np.empty(0, dtype=np.int64),
+                'spread': np.empty(0),
+                'observations': np.empty(0),
+                'democratic': np.empty(0),
+                'republican': np.empty(0)}
+
+    # The stride leaves a gap between states so no window can cross into
+    # another state's polls.
+    first = days.min()
+    stride = days.max() - first + 2*window + 1
+    keys = codes.astype(np.int64)*stride + (days - first)
+    ends = np.unique(np.concatenate((keys, keys + window)))
+
+    lower_bound = np.searchsorted(keys, ends - window, side='left')
+    count = np.searchsorted(keys, ends, side='right') - lower_bound
+
+    # Padded (windows x widest window) matrix of poll positions, with the
+    # padding pushed to the end of each row when sorting.
+    offsets = np.arange(count.max())
+    valid = offsets < count[:, None]
+    positions = np.where(valid, lower_bound[:, None] + offsets,
+                         lower_bound[:, None])
+    order = np.argsort(np.where(valid, spread[positions], np.inf),
+                       axis=1,
+                       kind='stable')
+    ranked = np.take_along_axis(positions, order, axis=1)
+
+    rows = np.arange(len(ends))
+    upr = ranked[rows, count//2]
+    lwr = ranked[rows, (count - 1)//2]
+    odd = count % 2 != 0
+
+    # Note the proportion of Democratic and Republican voters will not sum
+    # to 1 in most cases due to 3rd party candidates and don't knows/won't
+    # say.
+    return {'code': ends//stride,
+            'day': ends % stride + first,
+            'spread': np.where(odd,
+                               spread[upr],
+                               (spread[lwr] + spread[upr])/2),
+            'observations': np.where(
+                odd,
+                sample_size[upr],
+                np.trunc((sample_size[lwr] + sample_size[upr])/2)),
+            'democratic': np.where(
+                odd,
+                democratic[upr]/100,
+                ((democratic[lwr] + democratic[upr])/2)/100),
+            'republican': np.where(
+                odd,
+                republican[upr]/100,
+                ((republican[lwr] + republican[upr])/2)/100)}
+
+
+def _window_medians(chunk):
+    """Unpack a chunk of polls for window_medians in a worker process."""
+    return window_medians(**chunk)
+
+
+def median_polls(polls, window, workers=1):
+    """Return the rolling-window median poll for every state and date.
+
+    polls must be sorted by state abbreviation and end_date. With more
+    than one worker, the states are split into contiguous blocks that are
+    worked out in a process pool. Each worker only gets its own states'
+    poll arrays and sends back arrays, and the blocks come back in state
+    order, so the result is identical to a serial run.
+    """
+    states, codes = np.unique(polls['State abbreviation'].to_numpy(),
+                              return_inverse=True)
+    arrays = {'codes': codes,
+              'days': (polls['end_date'].to_numpy()
+                       .astype('datetime64[D]')
+                       .astype(np.int64)),
+              'spread': polls['Spread D-R'].to_numpy(dtype=float),
+              'sample_size': polls['sample_size'].to_numpy(dtype=float),
+              'democratic': polls['Democratic'].to_numpy(dtype=float),
+              'republican': polls['Republican'].to_numpy(dtype=float)}
+
+    if workers > 1 and len(states) > 1:
+        # Split on state boundaries so no state's windows are split.
+        bounds = np.searchsorted(
+            codes,
+            np.linspace(0, len(states), min(workers, len(states)) + 1)
+            .round()
+            .astype(int))
+        chunks = [dict({key: array[lwr:upr]
+                        for key, array in arrays.items()},
+                       window=window)
+                  for lwr, upr in zip(bounds[:-1], bounds[1:])
+                  if upr > lwr]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_window_medians, chunks))
+        medians = {key: np.concatenate([result[key] for result in results])
+                   for key in results[0]}
+    else:
+        medians = window_medians(window=window, **arrays)
+
+    return pd.DataFrame(
+        {'State abbreviation': states[medians['code']],
+         'Date': medians['day'].astype('datetime64[D]').astype(
+             'datetime64[ns]'),
+         'Spread D-R': medians['spread'],
+         'Observations': medians['observations'],
+         'Democratic proportion': medians['democratic'],
+         'Republican proportion': medians['republican']})
+
+
+def scatter_medians(state, medians):
+    """Write the median poll results into the state store in place.
+
+    Each (state, date) median maps straight to a row and column of the
+    store, so every metric is written with one indexed assignment and the
+    cost is linear in the number of medians. Medians dated after the last
+    day in the store are dropped.
+    """
+    rows = state.state_index(medians['State abbreviation'].to_numpy())
+    columns = state.date_index(medians['Date'])
+    found = (rows >= 0) & (columns >= 0) & (columns < len(state.dates))
+    for metric in ['Observations',
+                   'Spread D-R',
+                   'Democratic probability',
+                   'Democratic proportion',
+                   'Republican proportion']:
+        state[metric][rows[found], columns[found]] = \
+            medians[metric].to_numpy()[found]
+
+
+def derive(state, index=Ellipsis):
+    """Calculate the Republican probability and SEs at index in place.
+
+    index selects the (state, date) entries to calculate, everywhere by
+    default. The SEs are only calculated where there's a poll median.
+    """
+    state['Republican probability'][index] = \
+        1 - state['Democratic probability'][index]
+    observations = state['Observations'][index]
+    for party in ['Democratic', 'Republican']:
+        proportion = state['{0} proportion'.format(party)][index]
+        state['{0} SE'.format(party)][index] = np.where(
+            np.isnan(observations),
+            np.nan,
+            CONFIDENCE95*numpy.sqrt((proportion*(1 - proportion))
+                                    / observations))
+
+
+def _edge_derivative(h0, h1, m0, m1):
+    """Return the PCHIP end point derivative (three-point, shape-preserving).
+
+    h0 and m0 are the width and slope of the end interval, h1 and m1 those
+    of its neighbour.
+    """
+    derivative = ((2*h0 + h1)*m0 - h0*m1)/(h0 + h1)
+    return np.where(np.sign(derivative) != np.sign(m0),
+                    0.0,
+                    np.where((np.sign(m0) != np.sign(m1)) &
+                             (np.abs(derivative) > 3*np.abs(m0)),
+                             3*m0,
+                             derivative))
+
+
+def _pchip_derivatives(rows, valid, before, after):
+    """Return the PCHIP derivative at every value, as scipy's PCHIP.
+
+    Each value's neighbours are found from the previous and next value
+    positions, so the derivatives for every row come out of one pass.
+    """
+    length = rows.shape[-1]
+    # Previous and next value positions, excluding the entry itself.
+    previous = np.concatenate((np.full((rows.shape[0], 1), -1),
+                               before[:, :-1]), axis=-1)
+    following = np.concatenate((after[:, 1:],
+                                np.full((rows.shape[0], 1), length)),
+                               axis=-1)
+    first = previous < 0
+    last = following == length
+
+    def _take(positions):
+        return np.take_along_axis(rows,
+                                  np.clip(positions, 0, length - 1),
+                                  axis=-1)
+
+    # Width and slope of the intervals to the left and the right.
+    h_left = np.where(first, np.nan, np.arange(length) - previous)
+    h_right = np.where(last, np.nan, following - np.arange(length))
+    m_left = (rows - _take(previous))/h_left
+    m_right = (_take(following) - rows)/h_right
+
+    # Interior values - weighted harmonic mean of the slopes, zero at a
+    # turning point.
+    w1 = 2*h_right + h_left
+    w2 = h_right + 2*h_left
+    derivative = np.where(
+        (np.sign(m_left) != np.sign(m_right)) |
+        (m_left == 0) | (m_right == 0),
+        0.0,
+        1.0/((w1/m_left + w2/m_right)/(w1 + w2)))
+
+    # End values use the next interval in, or the slope if there are only
+    # two values.
+    next_right = np.take_along_axis(np.where(last, np.nan, h_right),
+                                    np.clip(following, 0, length - 1),
+                                    axis=-1)
+    next_slope = np.take_along_axis(m_right,
+                                    np.clip(following, 0, length - 1),
+                                    axis=-1)
+    derivative = np.where(
+        first,
+        np.where(np.isnan(next_right),
+                 m_right,
+                 _edge_derivative(h_right, next_right, m_right, next_slope)),
+        derivative)
+    previous_left = np.take_along_axis(h_left,
+                                       np.clip(previous, 0, length - 1),
+                                       axis=-1)
+    previous_slope = np.take_along_axis(m_left,
+                                        np.clip(previous, 0, length - 1),
+                                        axis=-1)
+    derivative = np.where(
+        last,
+        np.where(np.isnan(previous_left),
+                 m_left,
+                 _edge_derivative(h_left, previous_left, m_left,
+                                  previous_slope)),
+        derivative)
+    return np.where(valid, derivative, np.nan)
+
+
+def fill_gaps(values, method='linear'):
+    """Fill the gaps between values along the last axis in place.
+
+    method is one of FILL_METHODS:
+    linear - straight lines between values, as pandas interpolate.
+    previous - hold the previous value.
+    pchip - a smooth piecewise cubic (PCHIP) that doesn't overshoot, so
+        proportions and probabilities stay within the values either side.
+
+    Gaps before the first value stay missing and gaps after the last value
+    take the last value. Every row of a (state x date) array is filled in
+    the same vectorized pass.
+    """
+    rows = np.atleast_2d(values)
+    length = rows.shape[-1]
+    index = np.arange(length)
+    valid = ~np.isnan(rows)
+
+    # The previous and next value's position for every entry, -1 and length
+    # if there isn't one.
+    before = np.maximum.accumulate(np.where(valid, index, -1), axis=-1)
+    after = np.minimum.accumulate(
+        np.where(valid, index, length)[:, ::-1], axis=-1)[:, ::-1]
+
+    row, column = np.nonzero(~valid & (before >= 0))
+    lwr = before[row, column]
+    upr = np.minimum(after[row, column], length - 1)
+    trailing = after[row, column] == length
+    y0 = rows[row, lwr]
+    y1 = rows[row, upr]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if method == 'linear':
+            # Same arithmetic as numpy.interp, which pandas uses.
+            filled = (y1 - y0)/(upr - lwr)*(column - lwr) + y0
+        elif method == 'previous':
+            filled = y0
+        elif method == 'pchip':
+            derivative = _pchip_derivatives(rows, valid, before, after)
+            width = upr - lwr
+            t = (column - lwr)/width
+            filled = ((2*t**3 - 3*t**2 + 1)*y0
+                      + (t**3 - 2*t**2 + t)*width*derivative[row, lwr]
+                      + (-2*t**3 + 3*t**2)*y1
+                      + (t**3 - t**2)*width*derivative[row, upr])
+        else:
+            raise ValueError("Unknown fill method '{0}', expected one of "
+                             "{1}.".format(method, FILL_METHODS))
+
+    rows[row, column] = np.where(trailing, y0, filled)
+
+
+def poll_delta(previous, current):
+    """Return the polls that have been added, removed or changed.
+
+    A poll that has been edited shows up twice, once for the old values and
+    once for the new ones.
+    """
+    merged = previous.merge(current,
+                            on=list(previous.columns),
+                            how='outer',
+                            indicator=True)
+    return merged[merged['_merge'] != 'both'].drop(columns=['_merge'])
+
+
 # %%---------------------------------------------------------------------------
 # StateModel
 # -----------------------------------------------------------------------------
@@ -62,14 +394,24 @@ class StateModel():
     def __init__(self,
                  results,
                  polls,
-                 election_year):
-        """Initialize."""
+                 election_year,
+                 fill_method='linear',
+                 workers=1):
+        """Initialize.
+
+        fill_method is how the days between poll medians are filled in,
+        one of FILL_METHODS. workers is the number of processes to split
+        the states across when working out the poll medians, see
+        median_polls; only worth more than 1 on a multi-core host.
+        """
         self.year = election_year
         self.polls = polls
+        self.fill_method = fill_method
+        self.workers = workers
         self.start_date = pd.to_datetime('{0}-01-01'.format(self.year))
 
-        # The state dataframe will hold the results. We're going to seed
-        # the state frame with the results from the previous election, hence
+        # The state store will hold the results. We're going to seed
+        # the state store with the results from the previous election, hence
         # the -4.
         self.state = results[results['Year'] == election_year - 4].copy()
 
@@ -88,61 +430,42 @@ class StateModel():
         # or second place in any recent election, I'm going to ignore them
         # here and set the Republican probability to be 1-Democratic
         # probability.
-        self.state = (self.state
-                      .assign(**{'All votes':
-                                 (lambda x:
-                                  x['Democratic votes'] +
-                                  x['Other votes'] +
-                                  x['Republican votes'])})
-                      .assign(**{'Democratic proportion':
-                                 (lambda x:
-                                  (x['Democratic votes']/x['All votes']))})
-                      .assign(**{'Republican proportion':
-                                 (lambda x:
-                                  (x['Republican votes']/x['All votes']))})
-                      .assign(**{'Spread D-R':
-                                 (lambda x:
-                                  (x['Democratic votes'] -
-                                   x['Republican votes']) /
-                                  x['All votes'])})
-                      .assign(**{'Date': self.start_date})
-                      .assign(**{"Democratic probability":
-                                 lambda x: win_prob(x['Spread D-R'], 100)})
-                      .drop(columns=['Democratic votes',
-                                     'Other votes',
-                                     'Republican votes',
-                                     'All votes',
-                                     'Democratic electoral',
-                                     'Other electoral',
-                                     'Republican electoral',
-                                     'Year']))
-
-        # Pandas works faster when we pre-allocate memory as opposed
-        # to growing dataframes one entry at a time. What we're going to
-        # do is add dates to the self.state dataframe to grow to the
-        # corect size. This will lead to lots of NAs that we'll overwrite
-        # later.
-        # Step1. Get the date range
-        # The last day we can forecast is the date of the most recent poll.
-        _dates = pd.DataFrame(
-            {'Date': pd.date_range(start=self.start_date,
-                                   end=self.polls['end_date'].max())})
-        # Create column to do cartesian join on
-        _dates['_m'] = _dates.shape[0]*[1]
-        # Get state abbreviations and add column to join on
-        _states = pd.DataFrame({'State abbreviation':
-                                self.state['State abbreviation'].unique()})
-        _states['_m'] = _states.shape[0]*[1]
-        # Now do the cartesian join to give every state and every date
-        _cartesian = _dates.merge(_states,
-                                  on='_m',
-                                  how='inner').drop(columns=['_m'])
-        # Step 2. Now add it to the state frame to 'reserve' memory.
-        # This gives us the January 1 data and NA entries for every
-        # subsequent date.
-        self.state = self.state.merge(_cartesian,
-                                      on=['Date', 'State abbreviation'],
-                                      how='outer')
+        _seed = (self.state
+                 .assign(**{'All votes':
+                            (lambda x:
+                             x['Democratic votes'] +
+                             x['Other votes'] +
+                             x['Republican votes'])})
+                 .assign(**{'Democratic proportion':
+                            (lambda x:
+                             (x['Democratic votes']/x['All votes']))})
+                 .assign(**{'Republican proportion':
+                            (lambda x:
+                             (x['Republican votes']/x['All votes']))})
+                 .assign(**{'Spread D-R':
+                            (lambda x:
+                             (x['Democratic votes'] -
+                              x['Republican votes']) /
+                             x['All votes'])})
+                 .assign(**{"Democratic probability":
+                            lambda x: win_prob(x['Spread D-R'],
+                                               SEED_OBSERVATIONS)}))
+
+        # The state store pre-allocates a (state x date) array for each
+        # metric, full of NAs that we'll overwrite later. The first date is
+        # January 1 and the last day we can forecast is the date of the
+        # most recent poll.
+        self.state = StateStore(
+            states=_seed['State abbreviation'],
+            dates=[self.start_date, self.polls['end_date'].max()])
+        # Put the January 1 data in the first column.
+        _rows = self.state.state_index(
+            _seed['State abbreviation'].to_numpy())
+        for metric in ['Democratic proportion',
+                       'Republican proportion',
+                       'Spread D-R',
+                       'Democratic probability']:
+            self.state[metric][_rows, 0] = _seed[metric]
 
         # We only care about polls that occurred after our start date.
         # Sort the polls by state and end_date.
@@ -157,119 +480,237 @@ class StateModel():
 
         This method re-creates the state-level forecast from scratch each
         time because the new poll data may contain additional polls
-        conducted in the past.
+        conducted in the past. For a handful of new polls, see
+        update_incremental.
         """
-        # Setup
-        # -----
-        # This is the window size, but because we use <= and >=, it's actually
-        # the window size -1. This is a safer implementationm
-        window = 6
-
-        # Build state frame from polling data
+        # Build state store from polling data
         # -----------------------------------
-        # Step through each state
-        for state in self.polls['State abbreviation'].unique():
-            state_slice = self.polls[self.polls['State abbreviation'] == state]
-            # We need to step through each date to calculate an aggregate.
-            # Obvously, we'll use the poll dates, but there's a corner case
-            # where we have two polls on adjacent days. Using an entirely
-            # backwards looking algorthm (poll end_date - 6 days) will
-            # give an incorrect result in this case. So we look forward a
-            # week to capture the corner case.
-            _dummy = state_slice['end_date'].unique()
-            _dates = np.unique(np.sort(np.concatenate(
-                (_dummy, _dummy + pd.Timedelta(window, unit='d')))))
-
-            # Step through each unique poll date
-            for end_date in _dates:
-                # Slice the data so there are window + 1 days' polls in the
-                # slice. The sort is very important for the median
-                # sample size calculation which comes next.
-                date_slice = (state_slice[
-                    (state_slice['end_date'] <= end_date) &
-                    (state_slice['end_date'] >=
-                     end_date - pd.Timedelta(window, unit='d'))]).sort_values(
-                         'Spread D-R')
-                # Aggregate over these window+1 days worth of polls
-                spread = date_slice['Spread D-R'].median()
-
-                # Get the sample size for the median, either directly or as
-                # an 'estimate'.
-                # If the slice is an odd number, the median is the middle
-                # value.
-                # Note the proportion of Democratic and Republican voters
-                # will not sum to 1 in most cases due to 3rd party
-                # candidates and don't knows/won't say.
-                if date_slice.shape[0] % 2 != 0:
-                    observations = date_slice.iloc[
-                        date_slice.shape[0]//2]['sample_size']
-                    democratic = date_slice.iloc[
-                        date_slice.shape[0]//2]['Democratic']/100
-                    republican = date_slice.iloc[
-                        date_slice.shape[0]//2]['Republican']/100
-                # The slice is an even number, so the median is between two
-                # values.
-                else:
-                    upr = date_slice.shape[0]//2
-                    lwr = upr - 1
-                    observations = int(
-                        sum([date_slice.iloc[lwr]['sample_size'],
-                             date_slice.iloc[upr]['sample_size']])/2)
-                    democratic = (
-                        sum([date_slice.iloc[lwr]['Democratic'],
-                             date_slice.iloc[upr]['Democratic']])/2)/100
-                    republican = (
-                        sum([date_slice.iloc[lwr]['Republican'],
-                             date_slice.iloc[upr]['Republican']])/2)/100
-
-                probability_democratic = win_prob(spread, observations)
-
-                self.state.loc[
-                    (self.state['State abbreviation'] == state) &
-                    (self.state['Date'] == end_date),
-                    'Observations'] = observations
-
-                self.state.loc[
-                    (self.state['State abbreviation'] == state) &
-                    (self.state['Date'] == end_date), 'Spread D-R'] = spread
-
-                self.state.loc[
-                    (self.state['State abbreviation'] == state) &
-                    (self.state['Date'] == end_date),
-                    'Democratic probability'] = probability_democratic
-
-                self.state.loc[
-                    (self.state['State abbreviation'] == state) &
-                    (self.state['Date'] == end_date),
-                    'Democratic proportion'] = democratic
-
-                self.state.loc[
-                    (self.state['State abbreviation'] == state) &
-                    (self.state['Date'] == end_date),
-                    'Republican proportion'] = republican
-
-        # Fill in state table
+        # The medians for every state and poll date are calculated in one
+        # vectorized pass, see median_polls for the details.
+        medians = median_polls(self.polls, WINDOW, self.workers)
+
+        medians['Democratic probability'] = win_prob(
+            medians['Spread D-R'], medians['Observations'])
+
+        # Write every median into the state store in one go.
+        scatter_medians(self.state, medians)
+
+        # Fill in state store
         # -------------------
-        self.state['Republican probability'] = \
-            1 - self.state['Democratic probability']
-        # Using linear interpolation - we might want a smoother function in
-        # the future. Important to sort in the correct order first. This
-        # line of code relies on the first entry for each state being present.
-        self.state.loc[~self.state['Observations'].isna(), 'Democratic SE'] = \
-            (CONFIDENCE95*numpy.sqrt(
-                (self.state[
-                    'Democratic proportion']*(1-self.state[
-                        'Democratic proportion']))/self.state['Observations']))
-        self.state.loc[~self.state['Observations'].isna(), 'Republican SE'] = \
-            (CONFIDENCE95*numpy.sqrt(
-                (self.state[
-                    'Republican proportion']*(1-self.state[
-                        'Republican proportion']))/self.state['Observations']))
-
-        self.state = self.state.sort_values(['State abbreviation', 'Date'])
-
-        _states = []
-        for _state in self.state['State abbreviation'].unique():
-            _states.append(self.state[self.state['State abbreviation']
-                                      == _state].interpolate(method='linear'))
-        self.state = pd.concat(_states)
+        derive(self.state)
+        # Fill in the days between the medians for all states at once. This
+        # relies on the first entry for each state being present.
+        for metric in METRICS:
+            fill_gaps(self.state[metric], self.fill_method)
+
+    # %%
+    def update_incremental(self, previous, changed):
+        """
+        Update a previous state forecast with a handful of changed polls.
+
+        previous is an earlier result of update (e.g. state_{year}.csv) and
+        changed holds the polls that have been added or removed since it was
+        made (see poll_delta). Only the windows holding a changed poll are
+        recalculated, and only the spans between their neighbouring
+        unchanged medians are re-interpolated. The result is the same as
+        running update.
+
+        The PCHIP fill depends on the values either side of a span, so with
+        it the whole of an affected state's dates are re-filled. If the
+        changes end the forecast earlier than before, e.g. the latest poll
+        was removed, every state's values near the end depend on windows
+        that are now past the last date, so the forecast is rebuilt with
+        update.
+        """
+        previous = StateStore.from_frame(previous)
+        if len(self.state.dates) < len(previous.dates):
+            self.update()
+            return
+
+        # PCHIP derivatives depend on neighbouring values, so filling just
+        # a span isn't enough.
+        local = self.fill_method != 'pchip'
+
+        # Start from the previous forecast, extended to the date range of
+        # the current polls. January 1 from setup is what a span
+        # is reset to before it's recalculated.
+        seed = {metric: array[:, 0].copy()
+                for metric, array in self.state.metrics.items()}
+        _rows = previous.state_index(self.state.states)
+        _overlap = min(len(previous.dates), len(self.state.dates))
+        for metric in METRICS:
+            self.state[metric][_rows >= 0, :_overlap] = \
+                previous[metric][_rows[_rows >= 0], :_overlap]
+
+        changed = changed[changed['end_date'] >= self.start_date]
+        extended = len(self.state.dates) > len(previous.dates)
+        if extended:
+            affected = self.state.states
+        else:
+            affected = changed['State abbreviation'].unique()
+
+        for abbreviation in affected:
+            row = self.state.state_index(abbreviation)
+            if row < 0:
+                continue
+
+            # Dirty dates are the ends of windows that hold a changed poll,
+            # plus any dates that weren't in the previous forecast.
+            dirty = np.zeros(len(self.state.dates), dtype=bool)
+            for column in self.state.date_index(changed.loc[
+                    changed['State abbreviation'] == abbreviation,
+                    'end_date']):
+                dirty[column:column + WINDOW + 1] = True
+            if extended:
+                dirty[len(previous.dates):] = True
+            if not dirty.any():
+                continue
+
+            # Anchors are the dates interpolation runs between: January 1
+            # and the end of every window. A clean anchor has the same
+            # value as before, so splitting the dates at the clean anchors
+            # gives the spans that need to be rebuilt.
+            polls = self.polls[
+                self.polls['State abbreviation'] == abbreviation]
+            ends = self.state.date_index(polls['end_date'])
+            ends = np.concatenate(([0], ends, ends + WINDOW))
+            anchor = np.zeros(len(self.state.dates), dtype=bool)
+            anchor[ends[ends < len(anchor)]] = True
+            clean = anchor & ~dirty
+            segments = np.cumsum(clean)
+
+            for segment in np.unique(segments[dirty]):
+                inside = np.flatnonzero(segments == segment)
+                # The span runs from the clean anchor that opens this
+                # segment to the one that opens the next, if there is one.
+                first = inside[0]
+                last = min(inside[-1] + 1, len(anchor) - 1)
+                interior = inside[~clean[inside]]
+
+                for metric in METRICS:
+                    self.state[metric][row, interior] = np.nan
+                    if interior[0] == 0:
+                        self.state[metric][row, 0] = seed[metric][row]
+
+                window_polls = polls[
+                    (polls['end_date'] >= self.state.dates[interior[0]]
+                     - pd.Timedelta(WINDOW, unit='d')) &
+                    (polls['end_date'] <= self.state.dates[interior[-1]])]
+                medians = median_polls(window_polls, WINDOW)
+                medians = medians[medians['Date'].isin(
+                    self.state.dates[interior])]
+                medians['Democratic probability'] = win_prob(
+                    medians['Spread D-R'], medians['Observations'])
+                scatter_medians(self.state, medians)
+
+                derive(self.state, (row, interior))
+                if local:
+                    for metric in METRICS:
+                        fill_gaps(self.state[metric][row, first:last + 1],
+                                  self.fill_method)
+
+            if not local:
+                for metric in METRICS:
+                    self.state[metric][row, ~anchor] = np.nan
+                    fill_gaps(self.state[metric][row], self.fill_method)
+
+
+# %%
+# Code to benchmark the model
+if __name__ == "__main__":
+
+    import os
+    import time
+
+    # Time the write phase for a growing number of poll dates. The time per
+    # date should stay roughly constant, i.e. the write phase is linear.
+    print("scatter_medians")
+    _states = ['S{0:02d}'.format(index) for index in range(51)]
+    for _days in [250, 500, 1000, 2000, 4000]:
+        _dates = pd.date_range(start='2020-01-01', periods=_days)
+        _state = StateStore(states=_states, dates=_dates)
+        _medians = pd.DataFrame(
+            {'State abbreviation': np.repeat(_states, _days),
+             'Date': np.tile(_dates, len(_states))}
+            ).sample(frac=0.5, random_state=0)
+        for _metric in ['Democratic proportion',
+                        'Republican proportion',
+                        'Spread D-R',
+                        'Democratic probability',
+                        'Observations']:
+            _medians[_metric] = np.random.rand(_medians.shape[0])
+
+        _start = time.perf_counter()
+        scatter_medians(_state, _medians)
+        _elapsed = time.perf_counter() - _start
+        print("{0:>5} dates: {1:8.4f}s, {2:6.2f}us per (state, date)"
+              .format(_days, _elapsed, 1e6*_elapsed/_medians.shape[0]))
+
+    # Time the poll medians for a multi-cycle sized poll archive with a
+    # growing number of worker processes.
+    print("median_polls")
+    _rng = np.random.default_rng(0)
+    _polls = pd.DataFrame(
+        {'State abbreviation': _rng.choice(_states, 200000),
+         'end_date': (pd.Timestamp('2008-01-01')
+                      + pd.to_timedelta(_rng.integers(0, 5000, 200000),
+                                        unit='d')),
+         'Spread D-R': _rng.integers(-20, 20, 200000)/100,
+         'sample_size': _rng.integers(400, 1500, 200000).astype(float),
+         'Democratic': _rng.integers(35, 55, 200000).astype(float),
+         'Republican': _rng.integers(35, 55, 200000).astype(float)}
+        ).sort_values(by=['State abbreviation', 'end_date'])
+    # Any speedup depends on the host's cores, runs with more workers than
+    # cores only measure the pool's overhead.
+    _cores = os.cpu_count()
+    print("{0} cores".format(_cores))
+    _serial = None
+    for _workers in [1, 4, 8, 16]:
+        _start = time.perf_counter()
+        _medians = median_polls(_polls, WINDOW, _workers)
+        _elapsed = time.perf_counter() - _start
+        if _serial is None:
+            _serial = _elapsed
+            _expected = _medians
+        print("{0:>5} workers: {1:8.4f}s, speedup {2:5.2f}, identical {3}{4}"
+              .format(_workers, _elapsed, _serial/_elapsed,
+                      _medians.equals(_expected),
+                      ", more workers than cores" if _workers > _cores
+                      else ""))
+
+    # Check update_incremental gives the same as update, including when
+    # removing the latest poll ends the forecast earlier.
+    print("update_incremental")
+    _results = pd.read_csv(
+        os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                     'rawdata',
+                     'ElectionResults.csv'))
+    _polls = pd.DataFrame(
+        {'State abbreviation': ['OH', 'OH', 'OH', 'WY', 'WY'],
+         'end_date': pd.to_datetime(['2020-10-22', '2020-10-25',
+                                     '2020-10-27', '2020-10-30',
+                                     '2020-11-02']),
+         'Spread D-R': [0.01, -0.02, 0.03, -0.40, -0.35],
+         'sample_size': [800.0, 1000.0, 600.0, 400.0, 500.0],
+         'Democratic': [48.0, 46.0, 49.0, 28.0, 30.0],
+         'Republican': [47.0, 48.0, 46.0, 68.0, 65.0]})
+    for _fill_method in FILL_METHODS:
+        for _label, _previous, _current in [
+                ('add a poll', _polls.drop(index=1), _polls),
+                ('remove a poll', _polls, _polls.drop(index=1)),
+                ('remove the latest poll', _polls, _polls.drop(index=4))]:
+            _model = StateModel(_results, _previous, 2020, _fill_method)
+            _model.setup()
+            _model.update()
+            _before = _model.state.to_frame()
+            _model = StateModel(_results, _current, 2020, _fill_method)
+            _model.setup()
+            _model.update_incremental(_before,
+                                      poll_delta(_previous, _current))
+            _incremental = _model.state.to_frame()
+            _model = StateModel(_results, _current, 2020, _fill_method)
+            _model.setup()
+            _model.update()
+            print("{0:>8}, {1}: same as update {2}"
+                  .format(_fill_method, _label,
+                          _incremental.equals(_model.state.to_frame())))
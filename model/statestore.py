@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Project: silkworm.
+
+Description:
+Silkworm is a poll-based US Presidential Election forecaster.
+
+Author: Mike Woodward
+
+Created on: 2020-07-26
+
+"""
+
+# %%---------------------------------------------------------------------------
+# Module metadata
+# -----------------------------------------------------------------------------
+__author__ = "Mike Woodward"
+__license__ = "MIT"
+
+
+# %%---------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+import numpy as np
+import pandas as pd
+
+
+# %%---------------------------------------------------------------------------
+# Constants
+# -----------------------------------------------------------------------------
+# The state forecast metrics, in the column order of state_{year}.csv.
+METRICS = ['Democratic proportion',
+           'Republican proportion',
+           'Spread D-R',
+           'Democratic probability',
+           'Observations',
+           'Republican probability',
+           'Democratic SE',
+           'Republican SE']
+# Column order of the long format state forecast.
+COLUMNS = ['State abbreviation',
+           'Democratic proportion',
+           'Republican proportion',
+           'Spread D-R',
+           'Date',
+           'Democratic probability',
+           'Observations',
+           'Republican probability',
+           'Democratic SE',
+           'Republican SE']
+
+
+# %%---------------------------------------------------------------------------
+# StateStore
+# -----------------------------------------------------------------------------
+class StateStore():
+    """Holds the state forecast as one (state x date) array per metric.
+
+    The states are in alphabetical order of abbreviation and the dates run
+    daily with no gaps, so a state or a date maps straight to a row or a
+    column and per-state and per-date lookups are slices. The long format
+    DataFrame is only built for reading and writing files.
+    """
+
+    # %%
+    def __init__(self,
+                 states,
+                 dates,
+                 dtype=np.float64):
+        """Initialize with every metric missing."""
+        self.states = np.sort(np.asarray(states, dtype=object))
+        self.dates = pd.date_range(start=min(dates), end=max(dates))
+        # State names for display, set by whoever knows them.
+        self.names = self.states.copy()
+        self.metrics = {metric: np.full((len(self.states),
+                                         len(self.dates)),
+                                        np.nan,
+                                        dtype=dtype)
+                        for metric in METRICS}
+        self._rows = {state: row for row, state in enumerate(self.states)}
+
+    # %%
+    def __getitem__(self, metric):
+        """Return the (state x date) array for the metric."""
+        return self.metrics[metric]
+
+    # %%
+    def __setitem__(self, metric, values):
+        """Replace the (state x date) array for the metric."""
+        self.metrics[metric][...] = values
+
+    # %%
+    @property
+    def nbytes(self):
+        """Return the memory used by the metric arrays."""
+        return sum(array.nbytes for array in self.metrics.values())
+
+    # %%
+    def state_index(self, states):
+        """Return the row of a state abbreviation, or rows for an array.
+
+        Unknown states get -1.
+        """
+        if np.ndim(states) == 0:
+            return self._rows.get(states, -1)
+        return np.array([self._rows.get(state, -1) for state in states],
+                        dtype=np.int64)
+
+    # %%
+    def date_index(self, dates):
+        """Return the column of a date, or columns for an array of dates.
+
+        Dates outside the store give columns outside 0..len(dates) - 1.
+        """
+        if np.ndim(dates) == 0:
+            return (pd.Timestamp(dates) - self.dates[0]).days
+        return ((pd.DatetimeIndex(dates) - self.dates[0])
+                .days.to_numpy(dtype=np.int64))
+
+    # %%
+    def by_date(self, date):
+        """Return every state's forecast for the date, indexed by state."""
+        column = self.date_index(date)
+        return pd.DataFrame(
+            {metric: array[:, column]
+             for metric, array in self.metrics.items()},
+            index=pd.Index(self.states, name='State abbreviation'))
+
+    # %%
+    def by_state(self, state):
+        """Return the state's forecast for every date, indexed by date."""
+        row = self.state_index(state)
+        return pd.DataFrame(
+            {metric: array[row, :]
+             for metric, array in self.metrics.items()},
+            index=pd.Index(self.dates, name='Date'))
+
+    # %%
+    def copy(self):
+        """Return a deep copy."""
+        store = StateStore(self.states, self.dates)
+        store.names = self.names.copy()
+        store.metrics = {metric: array.copy()
+                         for metric, array in self.metrics.items()}
+        return store
+
+    # %%
+    def to_frame(self):
+        """Return the long format DataFrame, one row per state and date."""
+        frame = pd.DataFrame(
+            {'State abbreviation': np.repeat(self.states, len(self.dates)),
+             'Date': np.tile(self.dates.to_numpy(), len(self.states))})
+        for metric, array in self.metrics.items():
+            frame[metric] = array.ravel()
+        return frame[COLUMNS]
+
+    # %%
+    @classmethod
+    def from_frame(cls, frame, dtype=np.float64):
+        """Build a store from a long format DataFrame."""
+        store = cls(states=frame['State abbreviation'].unique(),
+                    dates=frame['Date'],
+                    dtype=dtype)
+        rows = store.state_index(frame['State abbreviation'].to_numpy())
+        columns = store.date_index(frame['Date'])
+        for metric in METRICS:
+            if metric in frame:
+                store.metrics[metric][rows, columns] = frame[metric]
+        return store
@@ -152,42 +152,32 @@ class ForecastByGeography():
     # %%
     def update(self, state):
         """Update view object."""
-        # Make a copy of the state data and change the copy
-        self.state = state.copy()
-        self.state['color index'] = self.state['Spread D-R']*100
-        self.state['color index'] = pd.cut(
-            self.state['color index'],
-            [-100, -10, -5, -2, -1, -0.5, 0.5, 1, 2, 5, 10, 100],
-            labels=[10, 9, 8, 7, 6, 5, 4, 3, 2, 1, 0])
-        self.state['color'] =\
-            self.state['color index'].map(
-                {k: v for k, v in enumerate(brewer['RdBu'][11])})
+        self.state = state
 
-        self.choosethedatefordisplay.start = self.state['Date'].min()
-        self.choosethedatefordisplay.value = self.state['Date'].max()
-        self.choosethedatefordisplay.end = self.state['Date'].max()
+        self.choosethedatefordisplay.start = self.state.dates[0]
+        self.choosethedatefordisplay.value = self.state.dates[-1]
+        self.choosethedatefordisplay.end = self.state.dates[-1]
 
         self._update_chart(self.choosethedatefordisplay.value_as_datetime)
 
     # %%
     def _update_chart(self, date):
         """Update chart based on date."""
-        _slice = self.state[self.state['Date'] == date]
+        # The slice is already in state abbreviation order
+        _slice = self.state.by_date(date)
+        _slice['color index'] = pd.cut(
+            _slice['Spread D-R']*100,
+            [-100, -10, -5, -2, -1, -0.5, 0.5, 1, 2, 5, 10, 100],
+            labels=[10, 9, 8, 7, 6, 5, 4, 3, 2, 1, 0])
+        _slice['color'] =\
+            _slice['color index'].map(
+                {k: v for k, v in enumerate(brewer['RdBu'][11])})
 
-        self.state_src.data['color'] = \
-            _slice[['State abbreviation',
-                    'color']].sort_values(
-                        'State abbreviation')['color'].to_list()
+        self.state_src.data['color'] = _slice['color'].to_list()
         self.state_src.data['Democratic percentage'] = \
-            _slice[['State abbreviation',
-                    'Democratic proportion']].sort_values(
-                        'State abbreviation')[
-                            'Democratic proportion'].to_list()
+            _slice['Democratic proportion'].to_list()
         self.state_src.data['Republican percentage'] = \
-            _slice[['State abbreviation',
-                    'Republican proportion']].sort_values(
-                        'State abbreviation')[
-                            'Republican proportion'].to_list()
+            _slice['Republican proportion'].to_list()
 
     # %%
     def callback_choosethedatefordisplay(self, attrname, old, new):
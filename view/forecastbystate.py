@@ -52,6 +52,7 @@ class ForecastByState():
         """
         self.controller = controller
         self.state = None
+        self.abbreviations = {}
         self.polls = None
 
         # figure
@@ -189,20 +190,12 @@ class ForecastByState():
     # %%
     def update(self, state, polls):
         """Update view object."""
-        # Make a copy of the state data
-        self.state = state.copy()
+        self.state = state
         self.polls = polls
-        self.state['Democratic lower'] =\
-            self.state['Democratic proportion'] - self.state['Democratic SE']
-        self.state['Democratic upper'] =\
-            self.state['Democratic proportion'] + self.state['Democratic SE']
-        self.state['Republican lower'] =\
-            self.state['Republican proportion'] - self.state['Republican SE']
-        self.state['Republican upper'] =\
-            self.state['Republican proportion'] + self.state['Republican SE']
 
         # Update the selection with the states
-        _states = self.state['State name'].unique().tolist()
+        _states = self.state.names.tolist()
+        self.abbreviations = dict(zip(_states, self.state.states))
         self.selectstate.options = _states
         self.selectstate.value = sample(_states, 1)[0]
 
@@ -214,16 +207,20 @@ class ForecastByState():
         """Update chart based on date."""
         # Trend data
         # ----------
-        _slice = self.state[self.state['State name'] == state]
+        _slice = self.state.by_state(self.abbreviations[state])
 
         self.cds.data = {
-            'Date': _slice['Date'].to_list(),
+            'Date': _slice.index.to_list(),
             'Democratic proportion': _slice['Democratic proportion'].to_list(),
             'Republican proportion': _slice['Republican proportion'].to_list(),
-            'Democratic lower': _slice['Democratic lower'].to_list(),
-            'Democratic upper': _slice['Democratic upper'].to_list(),
-            'Republican lower': _slice['Republican lower'].to_list(),
-            'Republican upper': _slice['Republican upper'].to_list()
+            'Democratic lower': (_slice['Democratic proportion']
+                                 - _slice['Democratic SE']).to_list(),
+            'Democratic upper': (_slice['Democratic proportion']
+                                 + _slice['Democratic SE']).to_list(),
+            'Republican lower': (_slice['Republican proportion']
+                                 - _slice['Republican SE']).to_list(),
+            'Republican upper': (_slice['Republican proportion']
+                                 + _slice['Republican SE']).to_list()
             }
 
         # Poll data
@@ -54,7 +54,13 @@ class ForecastByTime():
         # Create dummy data for the plot
         _df = pd.DataFrame({'Date': ['2030-12-31', '2031-12-31'],
                             'Democratic maximum': [300, 238],
-                            'Republican maximum': [238, 300]})
+                            'Republican maximum': [238, 300],
+                            'Democratic 5th percentile': [250, 188],
+                            'Democratic 95th percentile': [350, 288],
+                            'Republican 5th percentile': [188, 250],
+                            'Republican 95th percentile': [288, 350],
+                            'Democratic win probability': [0.6, 0.4],
+                            'Republican win probability': [0.4, 0.6]})
         _df['Date'] = pd.to_datetime(_df['Date'])
         self.cds = ColumnDataSource(_df)
         # Draw dummy lines
@@ -70,12 +76,27 @@ class ForecastByTime():
             line_color='red',
             line_width=2,
             source=self.cds)
+        # 5th to 95th percentile bands
+        _db = self.electoralcollegevotesbytime.varea(
+            x='Date',
+            y1='Democratic 5th percentile',
+            y2='Democratic 95th percentile',
+            fill_color='blue',
+            fill_alpha=0.1,
+            source=self.cds)
+        _rb = self.electoralcollegevotesbytime.varea(
+            x='Date',
+            y1='Republican 5th percentile',
+            y2='Republican 95th percentile',
+            fill_color='red',
+            fill_alpha=0.1,
+            source=self.cds)
         # 270 to win line
         _win270 = Span(location=270, dimension='width')
         self.electoralcollegevotesbytime.add_layout(_win270)
         # Add a legend outside of the plot
-        _legend = Legend(items=[('Democratic', [_dg]),
-                                ('Republican', [_rg])],
+        _legend = Legend(items=[('Democratic', [_dg, _db]),
+                                ('Republican', [_rg, _rb])],
                          location='top_right')
         self.electoralcollegevotesbytime.add_layout(_legend, 'right')
         self.electoralcollegevotesbytime.legend.click_policy = "hide"
@@ -90,7 +111,11 @@ class ForecastByTime():
                                     ("Democratic",
                                      "@{Democratic maximum}"),
                                     ("Republican",
-                                     "@{Republican maximum}")],
+                                     "@{Republican maximum}"),
+                                    ("Democratic win",
+                                     "@{Democratic win probability}{0.0%}"),
+                                    ("Republican win",
+                                     "@{Republican win probability}{0.0%}")],
                           formatters={'@Date': 'datetime'})
         self.electoralcollegevotesbytime.add_tools(hover)
 
@@ -113,10 +138,11 @@ class ForecastByTime():
         pass
 
     # %%
-    def update(self, electoral_maximum):
-        """Update view object."""
-        self.cds.data = {'Date': electoral_maximum['Date'],
-                         'Democratic maximum':
-                             electoral_maximum['Democratic maximum'],
-                         'Republican maximum':
-                             electoral_maximum['Republican maximum']}
+    def update(self, electoral_summary):
+        """Update view object.
+
+        electoral_summary is the electoral college summary table, see
+        electoral_summary in the electoral college model.
+        """
+        self.cds.data = {column: electoral_summary[column]
+                         for column in electoral_summary}
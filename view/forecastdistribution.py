@@ -26,7 +26,7 @@ __license__ = "MIT"
 from bokeh.models.widgets import (DateSlider,
                                   Panel)
 from bokeh.plotting import figure
-from bokeh.models import ColumnDataSource, Legend, Span
+from bokeh.models import ColumnDataSource, Legend, Range1d, Span
 from bokeh.layouts import column, row, Spacer
 from scipy.stats import norm
 
@@ -48,9 +48,12 @@ class ForecastDistribution():
 
         self.electoral_distribution = None
 
-        # Shows the forecast for electoral college votes over time.
+        # Shows the forecast for electoral college votes over time. The x
+        # axis is fixed as the chart is only sent the vote totals with some
+        # probability, which would otherwise rescale it for each date.
         self.ecvdistribution = figure(
             title="""Electoral college votes distribution""",
+            x_range=Range1d(-0.5, 538.5),
             x_axis_type="""linear""",
             x_axis_label="""Electoral college votes""",
             y_axis_label="""Probability""",
@@ -130,28 +133,27 @@ class ForecastDistribution():
 
     # %%
     def update(self, electoral_distribution):
-        """Update view object."""
+        """Update view object.
+
+        electoral_distribution is an ElectoralStore.
+        """
         self.electoral_distribution = electoral_distribution
         self.choosethedatefordisplay.end =\
-            self.electoral_distribution['Date'].max()
+            self.electoral_distribution.dates[-1]
         self.choosethedatefordisplay.value =\
-            self.electoral_distribution['Date'].max()
+            self.electoral_distribution.dates[-1]
         self.choosethedatefordisplay.start =\
-            self.electoral_distribution['Date'].min()
+            self.electoral_distribution.dates[0]
 
         self._update_chart(self.choosethedatefordisplay.value_as_datetime)
 
     # %%
     def _update_chart(self, date):
         """Redraw the chart by updating underlying data."""
-        _slice =\
-            (self.electoral_distribution[
-                self.electoral_distribution['Date'] == date]
-                [['Electoral college vote',
-                  'Democratic distribution',
-                  'Republican distribution']])
+        # Only send the vote totals with some probability to the browser
+        _slice = self.electoral_distribution.by_date(date, trim=True)
         self.cds.data =\
-            {'Electoral college votes': _slice['Electoral college vote'],
+            {'Electoral college votes': _slice.index.to_numpy(),
              'Democratic distribution': _slice['Democratic distribution'],
              'Republican distribution': _slice['Republican distribution']}
 